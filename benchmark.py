@@ -0,0 +1,1068 @@
+#!/usr/bin/env python3
+"""Benchmarks for email checker
+
+Requirements: the same as email_checker.py, Python 3.7+
+
+  usage: benchmark.py [-h] {decode,parse,check} ...
+
+  decode: decode_imap_utf7 and decode_header, compared to the previous
+          implementations (checking that the results are the same)
+
+  parse:  extraction of the From and Subject header fields, compared to
+          email.parser.BytesHeaderParser (checking that the results are the
+          same, on a corpus including malformed headers)
+
+  check:  end to end checks against a local fake IMAP server, with a fake
+          GNTP server receiving the notifications. Messages arrive at a
+          given rate to random mailboxes, and the latency from arrival to
+          notification is reported, with the commands, round trips, bytes
+          and CPU time per check of an IMAP connection. The CPU time
+          excludes the one of the fake servers. The network round trip time
+          can be simulated with -l. Unread messages to notify in the first
+          check are added with -u, and its peak memory traced with --memory.
+          E.g. for 500 accounts with 200 folders:
+
+            benchmark.py check -a 500 -m 200 -r 50 -p 60 -d 120
+
+          Settings from settings.ini can be replaced with -o, e.g.
+          -o general.notification_grouping=mailbox
+
+
+Copyright (C) 2013, 2014  Diego Fernández Gosende <dfgosende@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/gpl-3.0.html>.
+
+"""
+
+import os.path
+import re
+import base64
+import email.parser, email.header
+import timeit
+import time
+import random
+import select
+import threading
+import socketserver
+import tempfile
+import configparser
+import argparse
+import zlib
+import tracemalloc
+
+import email_checker
+
+
+# Reference implementations, as in email checker v0.2
+
+def decode_imap_utf7_v02(text):
+    if isinstance(text, bytes):
+        text = text.decode('ascii')
+    decoded = []
+    imap_utf7_text = []
+    for chr in text:
+        if imap_utf7_text:
+            if chr == '-':
+                if len(imap_utf7_text) == 1:
+                    decoded.append('&')
+                else:
+                    imap_utf7_text = b'+' + ''.join(
+                        imap_utf7_text[1:]).encode('ascii').replace(b',', b'/')\
+                        + b'-'
+                    decoded.append(imap_utf7_text.decode('utf-7'))
+                imap_utf7_text = []
+            else:
+                imap_utf7_text.append(chr)
+        elif chr == '&':
+            imap_utf7_text.append(chr)
+        else:
+            decoded.append(chr)
+    return ''.join(decoded)
+
+
+def decode_header_v02(raw_header):
+    header = ''
+    for header_part, header_part_charset in \
+                                    email.header.decode_header(raw_header):
+        if header_part_charset is not None:
+            header += header_part.decode(header_part_charset)
+        elif isinstance(header_part, bytes):
+            header += header_part.decode()
+        else:
+            header += header_part
+    return header
+
+
+# Corpora
+
+def encode_imap_utf7(text):
+    """Encode a string according to RFC 3501, section 5.1.3"""
+    encoded = []
+    shifted = []
+    for chr in text + '\0':
+        if ' ' <= chr <= '~' or chr == '\0':
+            if shifted:
+                encoded.append('&' + base64.b64encode(''.join(shifted)
+                    .encode('utf-16-be')).decode().rstrip('=')
+                    .replace('/', ',') + '-')
+                shifted = []
+            encoded.append('&-' if chr == '&' else chr.strip('\0'))
+        else:
+            shifted.append(chr)
+    return ''.join(encoded).encode('ascii')
+
+
+folder_names = [
+    'INBOX', 'Sent', 'Drafts', 'Trash', 'Junk', 'Archive', 'Notes',
+    '[Gmail]/All Mail', '[Gmail]/Sent Mail', '[Gmail]/Spam',
+    'Work/Projects/2014', 'Work/Clients/Smith & Sons', 'R&D', 'Q&A/Old',
+    'Elementos enviados', 'Correo no deseado', 'Papelera', 'Borradores',
+    'Отправленные', 'Входящие/Работа', 'Корзина', '送信済みメール',
+    'ゴミ箱', '迷惑メール', 'Entwürfe', 'Gelöschte Elemente', 'Éléments envoyés',
+    'Boîte de réception/Famille', 'Κάδος', 'Πρόχειρα', 'סל מיחזור',
+    'Lists/python-dev', 'Lists/linux-kernel', 'Receipts/2013', 'Travel ✈',
+]
+folder_corpus = [encode_imap_utf7(name) for name in folder_names] + [
+    b'&', b'&abc', b'a&-b&-c', b'&-&-&-', b'no-shift-here', b'&ZeVnLIqe-']
+folder_errors = [b'&ZeVnLIqe,-']
+
+header_corpus = [
+    'John Smith <john@example.com>',
+    'Your order has shipped',
+    '=?utf-8?B?0J/RgNC40LLQtdGCLCDQvNC40YAh?= <ivan@example.ru>',
+    '=?UTF-8?Q?Caf=C3=A9_con_leche?=',
+    '=?iso-8859-1?q?Mar=EDa_Fern=E1ndez?= <maria@example.es>',
+    '=?ISO-2022-JP?B?GyRCJUYlOSVIGyhC?=',
+    'Re: =?utf-8?B?5pel5pys6Kqe?= and more =?utf-8?Q?=E2=9C=93?=',
+    '"Support" <support@example.com>',
+    '=?utf-8?B?8J+YgCBlbW9qaQ==?=',
+    '[python-dev] Summary of Python tracker Issues',
+    '=?windows-1252?Q?=93Quoted=94_text?=',
+]
+header_errors = ['=?x-unknown-charset?Q?abc?=']
+
+
+raw_header_corpus = [
+    # as fetched, with HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)
+    b'From: John Smith <john@example.com>\r\n'
+    b'Subject: Your order has shipped\r\n'
+    b'Date: Thu, 16 Oct 2014 12:00:00 +0000\r\n'
+    b'Message-ID: <1@example.com>\r\n\r\n',
+    b'Subject: =?utf-8?B?0J/RgNC40LLQtdGCLCDQvNC40YAh?=\r\n'
+    b'From: =?iso-8859-1?q?Mar=EDa_Fern=E1ndez?= <maria@example.es>\r\n'
+    b'Message-ID: <2@example.com>\r\n\r\n',
+    # folded, and encoded words split between lines
+    b'From: "A very long display name, more than a line long" \r\n'
+    b'\t<long@example.com>\r\n'
+    b'Subject: Re: =?utf-8?B?5pel5pys6Kqe?=\r\n'
+    b' =?utf-8?Q?=E2=9C=93?= and more\r\n\r\n',
+    b'Subject:\r\n [python-dev] Summary of Python tracker Issues\r\n'
+    b'From: tracker@example.org\r\n\r\n',
+    # duplicate fields, case, spaces, missing and empty fields
+    b'from: first@example.com\r\nFROM: second@example.com\r\n'
+    b'SUBJECT:no space\r\nsubject: second\r\n\r\n',
+    b'Date: Thu, 16 Oct 2014 12:00:00 +0000\r\n\r\n',
+    b'From:\r\nSubject:   \t trailing   \r\n\r\n',
+    b'X-From: not@example.com\r\nSubject-X: no\r\n\r\n',
+    # LF line endings, no final blank line, a body
+    b'From: lf@example.com\nSubject: LF only\n\n',
+    b'From: end@example.com\r\nSubject: no blank line',
+    b'Subject: body next\r\n\r\nFrom: body@example.com\r\n',
+    b'',
+    # whole header
+    b'Received: from mx.example.com by imap.example.com\r\n'
+    b'DKIM-Signature: v=1; a=rsa-sha256; d=example.com;\r\n'
+    b'\tb=xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx\r\n'
+    b'From: Sender <sender@example.com>\r\nTo: user@example.com\r\n'
+    b'Subject: =?windows-1252?Q?=93Quoted=94_text?=\r\n'
+    b'Content-Type: text/plain; charset=utf-8\r\n\r\n',
+    # malformed or 8-bit, parsed by the stdlib parser
+    b'From: 8bit \xe9@example.com\r\nSubject: caf\xc3\xa9\r\n\r\n',
+    b'From: cr@example.com\rSubject: bare CR\r\n\r\n',
+    b' continuation first\r\nFrom: a@example.com\r\n\r\n',
+    b'From mbox line\r\nFrom: b@example.com\r\nSubject: c\r\n\r\n',
+    b'Subject : space before colon\r\nFrom: c@example.com\r\n\r\n',
+    b'From: d@example.com\r\nnot a field\r\nSubject: body\r\n\r\n',
+    b': no name\r\nFrom: e@example.com\r\n\r\n',
+]
+
+
+def check_parity(function, reference, corpus, errors=()):
+    for text in corpus:
+        result, expected = function(text), reference(text)
+        if result != expected:
+            raise SystemExit('{}({!r}): {!r} != {!r}'.format(
+                             function.__name__, text, result, expected))
+    for text in errors:
+        for f in (function, reference):
+            try:
+                f(text)
+            except Exception as err:
+                error_type = type(err)
+            else:
+                error_type = None
+            if f is function:
+                function_error = error_type
+        if function_error is not error_type:
+            raise SystemExit('{}({!r}): {} != {}'.format(function.__name__,
+                             text, function_error, error_type))
+
+
+def time_corpus(function, corpus, number):
+    timer = timeit.Timer(lambda: [function(text) for text in corpus])
+    return min(timer.repeat(5, number)) / (number * len(corpus)) * 1e6
+
+
+def bench_decode(number):
+    cases = [
+        ('decode_imap_utf7', folder_corpus, decode_imap_utf7_v02,
+         email_checker.decode_imap_utf7, folder_errors,
+         email_checker.decode_imap_utf7),
+        ('decode_header', header_corpus, decode_header_v02,
+         email_checker.decode_header, header_errors,
+         email_checker._decode_header),
+    ]
+    print('{:20} {:>10} {:>10} {:>10} {:>8}'.format(
+          '', 'v0.2 (us)', 'cold (us)', 'warm (us)', 'speedup'))
+    for name, corpus, reference, function, errors, cached in cases:
+        check_parity(function, reference, corpus, errors)
+        check_parity(cached.__wrapped__, reference, corpus, errors)
+        reference_time = time_corpus(reference, corpus, number)
+        cached.cache_clear()
+        cold_time = time_corpus(cached.__wrapped__, corpus, number)
+        warm_time = time_corpus(function, corpus, number)
+        print('{:20} {:10.2f} {:10.2f} {:10.2f} {:7.1f}x'.format(
+              name, reference_time, cold_time, warm_time,
+              reference_time / warm_time))
+
+
+def parse_header_stdlib(raw_header):
+    header = email.parser.BytesHeaderParser().parsebytes(bytes(raw_header))
+    return {name: header[name] for name in ('From', 'Subject')}
+
+
+def bench_parse(number):
+    parser = email_checker.HeaderFieldParser(('From', 'Subject'))
+    check_parity(parser, parse_header_stdlib, raw_header_corpus)
+    check_parity(parser, parse_header_stdlib, [memoryview(raw_header) for
+                                               raw_header in raw_header_corpus])
+    # as fetched, or the whole headers
+    corpora = [
+        ('fields', [make_header(i, 'Benchmark message {}'.format(i))
+                    .split(b'\r\n', 2)[2].replace(b'To: user@example.com\r\n',
+                    b'').replace(b'Content-Type: text/plain; '
+                    b'charset=utf-8\r\n', b'') for i in range(100)]),
+        ('whole', [make_header(i, 'Benchmark message {}'.format(i))
+                   for i in range(100)]),
+        ('corpus', raw_header_corpus),
+    ]
+    print('{:20} {:>12} {:>10} {:>8} {:>8} {:>10}'.format(
+          '', 'stdlib (us)', 'fast (us)', 'speedup', 'MB/s', 'fallbacks'))
+    for name, corpus in corpora:
+        # headers passed on to the stdlib parser
+        parser.fallbacks = 0
+        for raw_header in corpus:
+            parser(raw_header)
+        fallbacks = '{}/{}'.format(parser.fallbacks, len(corpus))
+        reference_time = time_corpus(parse_header_stdlib, corpus, number)
+        parser_time = time_corpus(parser, corpus, number)
+        size = sum(len(raw_header) for raw_header in corpus) / len(corpus)
+        print('{:20} {:12.2f} {:10.2f} {:7.1f}x {:8.1f} {:>10}'.format(
+              'parse_header ' + name, reference_time, parser_time,
+              reference_time / parser_time, size / parser_time, fallbacks))
+
+
+# Fake servers for end to end checks
+
+class FakeMailbox(object):
+    """Mailbox of the fake IMAP server
+    
+    The first 'old' messages are read ones, followed by 'unread' unread
+    ones, and their headers are only generated when fetched. Every change
+    increases the mod-sequence of the mailbox (CONDSTORE), the old
+    messages have the first one.
+    """
+    
+    def __init__(self, name, old=0, unread=0, uidvalidity=1,
+                 list_flags=()):
+        self.name = name
+        self.list_flags = list_flags
+        self.uidvalidity = uidvalidity
+        self.old = old
+        self.unread = unread
+        self.uidnext = old + unread + 1
+        self.new = {} # uid: header
+        self.seen = set() # new messages read since
+        self.highestmodseq = 1
+        self.modseqs = {} # uid: mod-sequence of the new messages
+        self.labels = {} # uid: (Gmail labels, thread id) of the new messages
+    
+    def add(self, header, labels=(), thread=None):
+        uid = self.uidnext
+        self.new[uid] = header
+        self.labels[uid] = labels, thread or uid
+        self.uidnext += 1
+        self.highestmodseq += 1
+        self.modseqs[uid] = self.highestmodseq
+        return uid
+    
+    def read(self, uid):
+        self.seen.add(uid)
+        self.highestmodseq += 1
+        self.modseqs[uid] = self.highestmodseq
+    
+    def uids(self):
+        return range(1, self.uidnext)
+    
+    def flags(self, uid):
+        if (uid in self.new or self.old < uid <= self.old + self.unread) \
+           and uid not in self.seen:
+            return ()
+        return ('\\Seen',)
+    
+    def gmail_labels(self, uid):
+        """Return the X-GM-LABELS and X-GM-THRID of a message"""
+        return self.labels.get(uid, ((r'\Inbox',), uid))
+    
+    def modseq(self, uid):
+        return self.modseqs.get(uid, 1)
+    
+    def header(self, uid):
+        if uid in self.new:
+            return self.new[uid]
+        if uid > self.old:
+            return make_header(uid, 'Unread message {}'.format(uid))
+        return make_header(uid, 'Old message {}'.format(uid))
+    
+    def status(self, items):
+        values = dict(MESSAGES=self.uidnext - 1, UIDNEXT=self.uidnext,
+                      UIDVALIDITY=self.uidvalidity,
+                      UNSEEN=len(self.new) + self.unread - len(self.seen),
+                      RECENT=0, HIGHESTMODSEQ=self.highestmodseq)
+        return ' '.join('{} {}'.format(item, values[item]) for item in items)
+
+
+def make_header(number, subject):
+    return ('Received: from mx.example.com by imap.example.com\r\n'
+            'DKIM-Signature: v=1; a=rsa-sha256; d=example.com; b={}\r\n'
+            'From: Sender {} <sender{}@example.com>\r\n'
+            'To: user@example.com\r\n'
+            'Subject: {}\r\n'
+            'Date: Thu, 16 Oct 2014 12:00:00 +0000\r\n'
+            'Message-ID: <{}@example.com>\r\n'
+            'X-Priority: {}\r\n'
+            'Content-Type: text/plain; charset=utf-8\r\n\r\n'.format(
+            'x' * 344, number % 50, number % 50, subject, number, 
+            number % 5 + 1)).encode()
+
+
+def make_benchmark_header(number):
+    return make_header(number, 'Benchmark message {}'.format(number))
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """Local IMAP server, supporting the commands used by email checker
+    
+    Every account has its own mailboxes. Commands, round trips (reads
+    waiting for the client), bytes and CPU time of the server threads are
+    counted. Responses are delayed until 'latency' seconds after their
+    commands arrived, as if over a network with that round trip time.
+    """
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+    all_mail = '[Gmail]/All Mail'
+    
+    def __init__(self, capabilities=('IMAP4rev1', 'IDLE', 'LIST-STATUS'),
+                 latency=0):
+        super().__init__(('127.0.0.1', 0), FakeIMAPHandler)
+        self.capabilities = ' '.join(capabilities)
+        self.latency = latency
+        self.accounts = {}
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.reset_counters()
+    
+    def reset_counters(self):
+        with self.lock:
+            self.commands = self.round_trips = self.sent = self.received = 0
+            self.cpu_time = 0
+    
+    def add_account(self, user, mailbox_names, old=0, unread=0):
+        """Add the mailboxes of an account
+        
+        With X-GM-EXT-1, a Gmail All Mail mailbox is added too, with every
+        message of the others, whose names are their labels.
+        """
+        self.accounts[user] = {name: FakeMailbox(name, old, unread)
+                               for name in mailbox_names}
+        if 'X-GM-EXT-1' in self.capabilities:
+            self.accounts[user][self.all_mail] = FakeMailbox(
+                    self.all_mail, old * len(mailbox_names),
+                    unread * len(mailbox_names), list_flags=(r'\All',))
+    
+    def deliver(self, user, mailbox_name, number):
+        """Add an unread message, with 'number' in its subject"""
+        header = make_benchmark_header(number)
+        with self.lock:
+            mailboxes = self.accounts[user]
+            if self.all_mail in mailboxes:
+                label = r'\Inbox' if mailbox_name == 'INBOX' else mailbox_name
+                mailboxes[self.all_mail].add(header, (label,), number)
+            return mailboxes[mailbox_name].add(header)
+    
+    def read(self, user, mailbox_name, uid):
+        """Mark a message as read, as done by another client"""
+        with self.lock:
+            self.accounts[user][mailbox_name].read(uid)
+    
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeIMAPHandler(socketserver.BaseRequestHandler):
+    
+    re_token = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+')
+    re_header_fields = re.compile(
+                            r'BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]', re.I)
+    
+    def setup(self):
+        self.buffer = b''
+        self.arrival = 0 # of the last data received
+        self.mailboxes = None
+        self.selected = None
+        self.compressor = self.decompressor = None
+        with self.server.lock:
+            self.server.connections += 1
+    
+    def handle(self):
+        self.write('* OK fake IMAP server ready')
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            start = time.thread_time()
+            tag, command, arguments = \
+                                (line.decode().rstrip('\r\n').split(' ', 2) +
+                                 ['', ''])[:3]
+            command = command.upper()
+            if command == 'UID':
+                command, arguments = (arguments.split(' ', 1) + [''])[:2]
+                command = 'UID_' + command.upper()
+            handler = getattr(self, 'do_' + command, None)
+            if handler is None:
+                self.write(tag + ' BAD unknown command')
+                result = None
+            elif self.mailboxes is None and command not in (
+                                    'CAPABILITY', 'NOOP', 'LOGIN', 'LOGOUT'):
+                self.write(tag + ' NO not authenticated')
+                result = None
+            else:
+                result = handler(tag, arguments)
+            with self.server.lock:
+                self.server.commands += 1
+                self.server.cpu_time += time.thread_time() - start
+            if result == 'BYE':
+                return
+    
+    def readline(self):
+        if b'\n' not in self.buffer:
+            with self.server.lock:
+                self.server.round_trips += 1
+        while b'\n' not in self.buffer:
+            data = self.request.recv(65536)
+            if not data:
+                return b''
+            with self.server.lock:
+                self.server.received += len(data)
+            if self.decompressor is not None:
+                data = self.decompressor.decompress(data)
+            self.buffer += data
+            self.arrival = time.monotonic()
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line + b'\n'
+    
+    def write(self, *lines):
+        data = b''.join(line if isinstance(line, bytes) else
+                        line.encode() + b'\r\n' for line in lines)
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + \
+                   self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        with self.server.lock:
+            self.server.sent += len(data)
+        delay = self.arrival + self.server.latency - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.request.sendall(data)
+    
+    def tokens(self, arguments):
+        return self.re_token.findall(arguments)
+    
+    def mailbox(self, token):
+        return self.mailboxes.get(token.strip('"'))
+    
+    def do_CAPABILITY(self, tag, arguments):
+        self.write('* CAPABILITY ' + self.server.capabilities, tag + ' OK done')
+    
+    def do_NOOP(self, tag, arguments):
+        self.write(tag + ' OK done')
+    
+    def do_LOGIN(self, tag, arguments):
+        user = self.tokens(arguments)[0].strip('"')
+        if user not in self.server.accounts:
+            self.write(tag + ' NO [AUTHENTICATIONFAILED] unknown user')
+            return
+        self.mailboxes = self.server.accounts[user]
+        self.write('{} OK [CAPABILITY {}] logged in'.format(
+                   tag, self.server.capabilities))
+    
+    def do_LOGOUT(self, tag, arguments):
+        self.write('* BYE logging out', tag + ' OK done')
+        return 'BYE'
+    
+    def do_COMPRESS(self, tag, arguments):
+        if 'COMPRESS=DEFLATE' not in self.server.capabilities or \
+           arguments.upper() != 'DEFLATE' or self.compressor is not None:
+            self.write(tag + ' NO not supported')
+            return
+        self.write(tag + ' OK compressing')
+        self.compressor = zlib.compressobj(wbits=-15)
+        self.decompressor = zlib.decompressobj(wbits=-15)
+    
+    def do_LIST(self, tag, arguments):
+        tokens = self.tokens(arguments)
+        status_items = None
+        if 'RETURN' in tokens and 'LIST-STATUS' in self.server.capabilities:
+            status_items = tokens[tokens.index('STATUS') + 2:-2]
+        lines = []
+        with self.server.lock:
+            for mailbox in self.mailboxes.values():
+                lines.append('* LIST ({}) "/" "{}"'.format(
+                             ' '.join(mailbox.list_flags), mailbox.name))
+                if status_items:
+                    lines.append('* STATUS "{}" ({})'.format(
+                                 mailbox.name, mailbox.status(status_items)))
+        self.write(*lines + [tag + ' OK done'])
+    
+    def do_STATUS(self, tag, arguments):
+        tokens = self.tokens(arguments)
+        mailbox = self.mailbox(tokens[0])
+        if mailbox is None:
+            self.write(tag + ' NO no such mailbox')
+            return
+        with self.server.lock:
+            status = mailbox.status(tokens[2:-1])
+        self.write('* STATUS "{}" ({})'.format(mailbox.name, status),
+                   tag + ' OK done')
+    
+    def do_SELECT(self, tag, arguments):
+        mailbox = self.mailbox(self.tokens(arguments)[0])
+        if mailbox is None:
+            self.write(tag + ' NO no such mailbox')
+            return
+        self.selected = mailbox
+        with self.server.lock:
+            uidnext = mailbox.uidnext
+            highestmodseq = mailbox.highestmodseq
+        lines = ['* {} EXISTS'.format(uidnext - 1), '* 0 RECENT',
+                 '* OK [UIDVALIDITY {}] UIDs valid'.format(mailbox.uidvalidity),
+                 '* OK [UIDNEXT {}] predicted next UID'.format(uidnext)]
+        if 'CONDSTORE' in self.server.capabilities:
+            lines.append('* OK [HIGHESTMODSEQ {}] modseq'.format(highestmodseq))
+        self.write(*lines + [tag + ' OK [READ-ONLY] selected'])
+    
+    do_EXAMINE = do_SELECT
+    
+    def do_CLOSE(self, tag, arguments):
+        self.selected = None
+        self.write(tag + ' OK done')
+    
+    def do_IDLE(self, tag, arguments):
+        exists = self.selected.uidnext
+        self.write('+ idling')
+        while True:
+            if self.selected.uidnext != exists:
+                exists = self.selected.uidnext
+                self.write('* {} EXISTS'.format(exists - 1))
+            if self.buffer or select.select([self.request], [], [], 0.01)[0]:
+                line = self.readline()
+                if not line:
+                    return 'BYE'
+                if line.strip().upper() == b'DONE':
+                    break
+        self.write(tag + ' OK idle done')
+    
+    def do_UID_SEARCH(self, tag, arguments):
+        tokens = self.tokens(arguments)
+        with self.server.lock:
+            uids = [uid for uid in self.selected.uids()
+                    if self.matches(tokens, uid)]
+            modseq = max(map(self.selected.modseq, uids), default=None)
+        line = '* SEARCH' + ''.join(' {}'.format(uid) for uid in uids)
+        if uids and 'MODSEQ' in arguments.upper():
+            line += ' (MODSEQ {})'.format(modseq)
+        self.write(line, tag + ' OK done')
+    
+    def matches(self, tokens, uid):
+        i = 0
+        while i < len(tokens):
+            match, i = self.match_key(tokens, i, uid)
+            if not match:
+                return False
+        return True
+    
+    def match_key(self, tokens, i, uid):
+        """Return if the search key at 'i' matches, and the next index"""
+        key = tokens[i].upper()
+        if key == '(':
+            end = i + 1
+            match = True
+            while tokens[end] != ')':
+                key_match, end = self.match_key(tokens, end, uid)
+                match = match and key_match
+            return match, end + 1
+        if key == 'ALL':
+            return True, i + 1
+        if key in ('SEEN', 'UNSEEN'):
+            seen = '\\Seen' in self.selected.flags(uid)
+            return seen == (key == 'SEEN'), i + 1
+        if key == 'NOT':
+            match, i = self.match_key(tokens, i + 1, uid)
+            return not match, i
+        if key == 'OR':
+            match1, i = self.match_key(tokens, i + 1, uid)
+            match2, i = self.match_key(tokens, i, uid)
+            return match1 or match2, i
+        if key == 'UID':
+            return uid in self.uid_set(tokens[i + 1]), i + 2
+        if key == 'CHARSET':
+            return True, i + 2
+        if key == 'MODSEQ':
+            return self.selected.modseq(uid) >= int(tokens[i + 1]), i + 2
+        if key == 'HEADER':
+            return self.header_contains(uid, tokens[i + 1],
+                                        tokens[i + 2]), i + 3
+        if key in ('FROM', 'TO', 'SUBJECT'):
+            return self.header_contains(uid, key, tokens[i + 1]), i + 2
+        raise ValueError('unsupported search key: ' + key)
+    
+    def header_contains(self, uid, name, value):
+        name = name.strip('"').lower().encode()
+        value = value.strip('"').lower().encode()
+        for line in self.selected.header(uid).split(b'\r\n'):
+            field, _, field_value = line.partition(b':')
+            if field.lower() == name and value in field_value.lower():
+                return True
+        return False
+    
+    def uid_set(self, sequence_set):
+        last = self.selected.uidnext - 1
+        uids = set()
+        for part in sequence_set.split(','):
+            first, _, end = part.partition(':')
+            first = last if first == '*' else int(first)
+            end = first if not end else last if end == '*' else int(end)
+            uids.update(range(min(first, end), max(first, end) + 1))
+        return uids
+    
+    def do_UID_FETCH(self, tag, arguments):
+        sequence_set, items = arguments.split(' ', 1)
+        fields = self.re_header_fields.search(items)
+        if fields:
+            names = fields.group(1).upper().encode().split()
+        with self.server.lock:
+            uids = sorted(self.uid_set(sequence_set) &
+                          set(self.selected.uids()))
+        # every message is sent on its own, as a server streaming them
+        for uid in uids:
+            data = ['UID {}'.format(uid)]
+            with self.server.lock:
+                if 'FLAGS' in items.upper():
+                    data.append('FLAGS ({})'.format(
+                                ' '.join(self.selected.flags(uid))))
+                if 'X-GM-LABELS' in items.upper():
+                    labels, thread = self.selected.gmail_labels(uid)
+                    data.append('X-GM-THRID {} X-GM-LABELS ({})'.format(
+                                thread, ' '.join('"{}"'.format(
+                                label.replace('\\', '\\\\'))
+                                for label in labels)))
+                header = self.selected.header(uid)
+            if fields:
+                header = b''.join(line + b'\r\n' for line in
+                                  header.split(b'\r\n')
+                                  if line.split(b':')[0].upper() in names
+                                  ) + b'\r\n'
+                data.append('BODY[HEADER.FIELDS ({})] {{{}}}'.format(
+                            fields.group(1), len(header)))
+            elif 'BODY.PEEK[HEADER]' in items.upper():
+                data.append('BODY[HEADER] {{{}}}'.format(len(header)))
+            else:
+                header = None
+            line = '* {} FETCH ({}'.format(uid, ' '.join(data))
+            if header is None:
+                self.write(line + ')')
+            else:
+                self.write(line, header, ')')
+        self.write(tag + ' OK done')
+
+
+class FakeGNTPServer(socketserver.ThreadingTCPServer):
+    """Local GNTP server, recording the received notifications
+    
+    Notifications are saved as (time received, title, text).
+    """
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+    
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeGNTPHandler)
+        self.lock = threading.Lock()
+        self.notifications = []
+        self.registrations = 0
+        self.cpu_time = 0
+    
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeGNTPHandler(socketserver.StreamRequestHandler):
+    
+    def handle(self):
+        start = time.thread_time()
+        info, headers = self.read_block()
+        blocks = [headers]
+        for i in range(int(headers.get('Notifications-Count', 0))):
+            blocks.append(self.read_block()[1])
+        resources = {value for block in blocks for value in block.values()
+                     if value.startswith('x-growl-resource://')}
+        for resource in resources:
+            line, resource_headers = self.read_block()
+            self.rfile.read(int(resource_headers['Length']) + 4)
+        message_type = info.split()[1]
+        self.wfile.write('GNTP/1.0 -OK NONE\r\nResponse-Action: {}\r\n\r\n'
+                         .format(message_type).encode())
+        with self.server.lock:
+            if message_type == 'NOTIFY':
+                self.server.notifications.append((time.monotonic(),
+                    headers.get('Notification-Title', ''),
+                    headers.get('Notification-Text', '')))
+            elif message_type == 'REGISTER':
+                self.server.registrations += 1
+            self.server.cpu_time += time.thread_time() - start
+    
+    def read_block(self):
+        """Return the first line and the headers of a block of lines"""
+        first = None
+        headers = {}
+        key = None
+        while True:
+            line = self.rfile.readline()
+            if line in (b'\r\n', b''):
+                return first, headers
+            line = line.decode('utf-8').rstrip('\r\n')
+            if first is None and not headers and line.startswith('GNTP/'):
+                first = line
+            elif ': ' in line:
+                key, value = line.split(': ', 1)
+                headers[key] = value
+            elif key is not None: # new lines in the value
+                headers[key] += '\n' + line
+
+
+# End to end checks
+
+class CheckBenchmark(object):
+    """Run an email checker against the fake servers"""
+    
+    re_message = re.compile(r'Benchmark message (\d+)')
+    
+    def __init__(self, args):
+        self.args = args
+        capabilities = ['IMAP4rev1']
+        if args.idle:
+            capabilities.append('IDLE')
+        if not args.no_list_status:
+            capabilities.append('LIST-STATUS')
+        if args.condstore:
+            capabilities.append('CONDSTORE')
+        if args.compress:
+            capabilities.append('COMPRESS=DEFLATE')
+        if args.gmail:
+            capabilities.append('X-GM-EXT-1')
+        self.imap = FakeIMAPServer(capabilities, args.latency / 1000)
+        self.growl = FakeGNTPServer()
+        self.users = ['user{}'.format(i) for i in range(args.accounts)]
+        names = ['INBOX'] + ['Folder {}'.format(i)
+                             for i in range(1, args.mailboxes)]
+        for user in self.users:
+            self.imap.add_account(user, names, args.messages, args.unread)
+        self.targets = [(user, name) for user in self.users for name in names]
+        self.arrivals = {} # message number: arrival time
+        self.filtered = set() # message numbers excluded by the profile rules
+        self.cycles = 0
+        self.cycles_lock = threading.Lock()
+        self.error = None
+    
+    def write_settings(self, directory):
+        """Write a settings file for the benchmark profiles, return its path"""
+        config = configparser.ConfigParser(default_section='default',
+                                           allow_no_value=True)
+        config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'settings.ini'))
+        for section in config.sections():
+            if 'hostname' in config[section]:
+                config.remove_section(section)
+        config['general'].update(
+            profile='user0', verbose='no', state_path=os.path.join(
+            directory, 'state.db'), growl_hostname='127.0.0.1',
+            growl_port=str(self.growl.server_address[1]),
+            growl_password='', notification_window='0',
+            notification_grouping='none', notification_rate='0')
+        config['default'].update(
+            port=str(self.imap.server_address[1]), ssl='no', url='', icon='',
+            period=str(self.args.period), min_period=str(self.args.period),
+            max_period=str(self.args.period * 10),
+            account_connections=str(self.args.connections))
+        for user in self.users:
+            config[user] = dict(hostname='127.0.0.1', user_id=user,
+                                password='password')
+        for option in self.args.option:
+            key, value = option.split('=', 1)
+            section, key = key.split('.', 1)
+            config[section][key] = value
+        path = os.path.join(directory, 'settings.ini')
+        with open(path, 'w') as settings_file:
+            config.write(settings_file)
+        return path
+    
+    def count_cycles(self, checker):
+        check_cycle = checker._check_cycle
+        def counted_check_cycle(*args):
+            result = check_cycle(*args)
+            with self.cycles_lock:
+                self.cycles += 1
+            return result
+        checker._check_cycle = counted_check_cycle
+    
+    def run(self):
+        self.imap.start()
+        self.growl.start()
+        with tempfile.TemporaryDirectory() as directory:
+            settings_path = self.write_settings(directory)
+            if len(self.users) > 1:
+                checker = email_checker.MultiChecker(settings_path)
+                lanes = [lane for lanes in checker.accounts.values()
+                         for lane in lanes]
+            else:
+                checker = email_checker.EmailChecker(settings_path)
+                lanes = [checker]
+            checker.config['general']['verbose'] = str(self.args.verbose)
+            for lane in lanes:
+                self.count_cycles(lane)
+            checker.register_gntp()
+            checker.start_metrics()
+            waiter = threading.Thread(target=self.wait, args=(checker,))
+            if self.args.memory:
+                tracemalloc.start()
+            start = time.monotonic()
+            checker.check()
+            waiter.start()
+            # the first check of every connection, notifying only the
+            # initially unread messages
+            while self.cycles < len(lanes) and self.error is None:
+                time.sleep(0.01)
+            first_check = time.monotonic() - start
+            if self.args.memory:
+                first_check_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            results = self.measure(lanes[0])
+            checker._queue.put(checker.exit)
+            waiter.join()
+            if checker.state is not None:
+                checker.state.close()
+        self.imap.stop()
+        self.growl.stop()
+        if self.error is not None:
+            raise SystemExit(self.error)
+        self.report(first_check, *results)
+        if self.args.memory:
+            print('first check peak memory: {:.1f} MiB'.format(
+                  first_check_memory / 2 ** 20))
+    
+    def wait(self, checker):
+        try:
+            checker.wait()
+        except SystemExit as err:
+            self.error = err.code
+    
+    def measure(self, checker):
+        """Deliver messages during the benchmark, return the counters"""
+        self.imap.reset_counters()
+        with self.cycles_lock:
+            self.cycles = 0
+        imap_cpu_time, growl_cpu_time = self.imap.cpu_time, self.growl.cpu_time
+        cpu_time = time.process_time()
+        start = time.monotonic()
+        end = start + self.args.duration
+        number = 0
+        next_arrival = start
+        while self.error is None:
+            next_arrival += random.expovariate(self.args.rate)
+            if next_arrival >= end:
+                break
+            time.sleep(max(next_arrival - time.monotonic(), 0))
+            if random.random() < self.args.inbox:
+                user, mailbox_name = random.choice(self.users), 'INBOX'
+            else:
+                user, mailbox_name = random.choice(self.targets)
+            number += 1
+            self.arrivals[number] = time.monotonic()
+            self.imap.deliver(user, mailbox_name, number)
+            if self.is_filtered(checker, number):
+                self.filtered.add(number)
+        # wait for the last notifications
+        deadline = time.monotonic() + self.args.period + 10
+        while time.monotonic() < deadline and self.error is None and \
+              len(self.get_latencies()) < \
+              len(self.arrivals) - len(self.filtered):
+            time.sleep(0.05)
+        elapsed = time.monotonic() - start
+        cpu_time = time.process_time() - cpu_time - \
+                   (self.imap.cpu_time - imap_cpu_time) - \
+                   (self.growl.cpu_time - growl_cpu_time)
+        return elapsed, cpu_time
+    
+    def is_filtered(self, checker, number):
+        """Return True if a message is excluded by the notification rules"""
+        header = checker.parse_header(make_benchmark_header(number))
+        return not checker.message_filter.matches(
+                        email_checker.decode_header(header['From']),
+                        email_checker.decode_header(header['Subject']),
+                        header.get('X-Priority'))
+    
+    def get_latencies(self):
+        """Return the latencies of the notified messages, in seconds"""
+        latencies = {}
+        with self.growl.lock:
+            notifications = list(self.growl.notifications)
+        for notified, title, text in notifications:
+            for match in self.re_message.finditer(title + '\n' + text):
+                number = int(match.group(1))
+                if number in self.arrivals and number not in latencies:
+                    latencies[number] = notified - self.arrivals[number]
+        return sorted(latencies.values())
+    
+    def report(self, first_check, elapsed, cpu_time):
+        latencies = self.get_latencies()
+        cycles = max(self.cycles, 1)
+        print('accounts: {}, mailboxes: {}, connections: {}'.format(
+              len(self.users), len(self.targets), self.imap.connections))
+        print('first check: {:.2f} s'.format(first_check))
+        print('checks: {} in {:.1f} s'.format(self.cycles, elapsed))
+        print('messages: {} arrived, {}{} notified, {} notifications'.format(
+              len(self.arrivals), '{} filtered out, '.format(
+              len(self.filtered)) if self.filtered else '', len(latencies),
+              len(self.growl.notifications)))
+        if latencies:
+            print('latency (ms): p50 {:.0f}, p90 {:.0f}, p99 {:.0f}, '
+                  'max {:.0f}'.format(*[percentile(latencies, p) * 1000
+                                        for p in (50, 90, 99, 100)]))
+        print('per check: {:.1f} commands, {:.1f} round trips, {:.0f} bytes '
+              'sent, {:.0f} bytes received, {:.2f} ms CPU'.format(
+              self.imap.commands / cycles, self.imap.round_trips / cycles,
+              self.imap.received / cycles, self.imap.sent / cycles,
+              cpu_time / cycles * 1000))
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a sorted list (nearest rank)"""
+    return values[max(int(round(p / 100 * len(values))) - 1, 0)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for email checker')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    decode_parser = subparsers.add_parser('decode',
+                        help='decoding of mailbox names and headers')
+    decode_parser.add_argument('-n', '--number', type=int, default=1000,
+                               help='number of loops over the corpora')
+    parse_parser = subparsers.add_parser('parse',
+                        help='extraction of header fields')
+    parse_parser.add_argument('-n', '--number', type=int, default=1000,
+                              help='number of loops over the corpora')
+    check_parser = subparsers.add_parser('check',
+                        help='end to end checks against fake servers')
+    check_parser.add_argument('-a', '--accounts', type=int, default=1,
+                              help='number of accounts (profiles)')
+    check_parser.add_argument('-m', '--mailboxes', type=int, default=10,
+                              help='number of mailboxes per account')
+    check_parser.add_argument('-n', '--messages', type=int, default=100,
+                              help='number of read messages per mailbox')
+    check_parser.add_argument('-u', '--unread', type=int, default=0,
+                              help='number of unread messages per mailbox, '
+                                   'notified in the first check')
+    check_parser.add_argument('-r', '--rate', type=float, default=5,
+                              help='new messages per second')
+    check_parser.add_argument('-i', '--inbox', type=float, default=0.5,
+                              help='fraction of the new messages to INBOX')
+    check_parser.add_argument('-d', '--duration', type=float, default=10,
+                              help='seconds of arrival of new messages')
+    check_parser.add_argument('-p', '--period', type=int, default=2,
+                              help='seconds between checks, at least '
+                                   '(up to 10 times more for quiet mailboxes)')
+    check_parser.add_argument('-c', '--connections', type=int, default=1,
+                              help='connections per account')
+    check_parser.add_argument('-l', '--latency', type=float, default=0,
+                              help='round trip time to the IMAP server, in '
+                                   'milliseconds')
+    check_parser.add_argument('--idle', action='store_true',
+                              help='support the IDLE command')
+    check_parser.add_argument('--no-list-status', action='store_true',
+                              help="don't support the LIST-STATUS command")
+    check_parser.add_argument('--condstore', action='store_true',
+                              help='support the CONDSTORE extension')
+    check_parser.add_argument('--compress', action='store_true',
+                              help='support the COMPRESS=DEFLATE extension')
+    check_parser.add_argument('--gmail', action='store_true',
+                              help='support the Gmail X-GM-EXT-1 extension, '
+                                   'with an All Mail mailbox')
+    check_parser.add_argument('--memory', action='store_true',
+                              help='trace the peak memory of the first check '
+                                   '(slower)')
+    check_parser.add_argument('-o', '--option', action='append', default=[],
+                              metavar='SECTION.KEY=VALUE',
+                              help='replace a setting')
+    check_parser.add_argument('-v', '--verbose', action='store_true',
+                              help='show the email checker output')
+    args = parser.parse_args()
+    if args.benchmark == 'decode':
+        bench_decode(args.number)
+    elif args.benchmark == 'parse':
+        bench_parse(args.number)
+    elif args.benchmark == 'check':
+        CheckBenchmark(args).run()
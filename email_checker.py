@@ -3,13 +3,14 @@
 
 Requirements:
 - IMAP access
-- Python 3.3+ <http://www.python.org/> (if not using a build)
+- Python 3.6+ <http://www.python.org/> (if not using a build)
 - gntp Python library <http://pythonhosted.org/gntp/> (if not using a build)
 - a running notification application supporting the GNTP protocol, e.g. Growl
   and its ports
 
 Just a very simple script, without any interaction with the user. To end it, 
-just kill it.
+just kill it, or send it an 'exit' command with -c if 'control_socket' is set 
+(not on Windows).
 
 Tested with Gmail and Outlook, Windows 7 (Growl for Windows) and Linux 
 Mint 15 (Growl For Linux).
@@ -17,8 +18,8 @@
 A configuration file is needed (default: settings.ini). Some of the 
 settings can be specified from command line:
 
-  usage: email_checker.py [-h] [-V] [-v] [-s SETTINGS] [-p PROFILE] [-u USER]
-                          [-x PASS]
+  usage: email_checker.py [-h] [-V] [-v] [-s SETTINGS] [-p PROFILE] [-a]
+                          [-w WORKERS] [-u USER] [-x PASS] [-c COMMAND]
   optional arguments:
     -h, --help            show this help message and exit
     -V, --version         show program's version number and exit
@@ -27,8 +28,15 @@
                           specify a custom settings file path
     -p PROFILE, --profile PROFILE
                           choose a profile from the settings file
+    -a, --all             check every profile from the settings file
+    -w WORKERS, --workers WORKERS
+                          check every profile, split between a number of
+                          processes
     -u USER, --user USER  specify the user
     -x PASS, --pass PASS  specify the password
+    -c COMMAND, --control COMMAND
+                          send a command to the running instance: status, check-
+                          now, exit, pause, reload-config, resume
 
 Changelog:
   0.1 [2013-11-10]
@@ -37,6 +45,29 @@
     improve exception handling / reconnection
     fix not exiting after a single check
     decode correctly mailbox names
+  0.3 [unreleased]:
+    wait for new messages with IMAP IDLE when supported by the server
+    keep the IMAP connection open between checks
+    add -a/--all option, checking every profile concurrently, with IDLE
+    save the mailboxes state, not notifying again after restarting
+    select only the mailboxes whose STATUS shows new unread messages
+    fetch only the needed header fields of the new messages, in batches
+    send notifications from a separate thread, merging bursts of them
+    keep pending notifications on disk, retrying while the notifier fails
+    reuse the mailbox list between checks, allow glob patterns in excluded names
+    cache decoded mailbox names and headers, benchmark.py
+    add an 'ssl' setting, and benchmark.py check against local fake servers
+    time the check phases, served in Prometheus format and/or dumped as JSON
+    poll every mailbox at its own adaptive period, reconnect with a backoff
+    add -w/--workers, splitting the profiles between worker processes
+    use CONDSTORE when supported, not notifying messages read in the meantime
+    pipeline the IMAP commands, and benchmark.py check with a simulated latency
+    notify the fetched messages as they are read, with bounded memory
+    extract only the From and Subject fields of the headers, benchmark.py parse
+    compress the connection with COMPRESS=DEFLATE, resume TLS sessions
+    add -c/--control, sending commands through a local control socket
+    filter notifications by sender, subject or priority, searching on the server
+    on Gmail, search only All Mail, notifying by label and once per thread
 
 
 Homepage: <https://github.com/vdcrim/email_checker>
@@ -61,15 +92,32 @@
 
 import os.path
 import re
-from collections import defaultdict
+import glob
+from collections import OrderedDict, deque
 import imaplib
 import email.parser, email.header
 from datetime import datetime, timezone
 import time
+import select
+import stat
+import socket
+import socketserver
 import threading
 import queue
+import asyncio
+import concurrent.futures
+import multiprocessing
+import functools
+import bisect
+import random
+import io
 import configparser
 import argparse
+import sqlite3
+import ssl
+import zlib
+import json
+import http.server
 
 import gntp.notifier
 if os.name == 'nt':
@@ -90,23 +138,1240 @@
 # IMAP reference: <http://tools.ietf.org/html/rfc3501.html>
 
 
+class IMAPConnection(imaplib.IMAP4_SSL):
+    """IMAP4 over SSL client, with support for the IDLE command, CONDSTORE, 
+    pipelining and COMPRESS=DEFLATE
+    
+    With 'use_ssl' False the connection is not encrypted, e.g. for local 
+    servers. Up to 'pipeline_depth' commands are sent before reading their 
+    responses, 1 meaning one command at a time as usual. Reads waiting 
+    more than 'timeout' seconds, e.g. on a half-open connection, raise 
+    abort. Waiting in IDLE is not limited by it.
+    
+    Every connection uses the same SSL context, and the TLS session of the 
+    last connection to a server is resumed, so reconnecting takes an 
+    abbreviated handshake.
+    
+    IDLE reference: <http://tools.ietf.org/html/rfc2177.html>
+    CONDSTORE reference: <http://tools.ietf.org/html/rfc7162.html>
+    COMPRESS reference: <http://tools.ietf.org/html/rfc4978.html>
+    """
+    
+    re_idle_response = re.compile(br'\* (\d+) (EXISTS|RECENT)$')
+    re_capability_code = re.compile(br'\[CAPABILITY ([^\]]*)\]')
+    
+    shared_ssl_context = None
+    tls_sessions = {} # (host, port): last TLS session
+    _tls_lock = threading.Lock()
+    
+    def __init__(self, host='', port=imaplib.IMAP4_SSL_PORT, use_ssl=True, 
+                 pipeline_depth=1, timeout=None):
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.pipeline_depth = max(pipeline_depth, 1)
+        self.sent = 0
+        self.handshake_time = None
+        self.session_reused = False
+        self.compressor = None
+        self.deflated = [0, 0] # bytes sent, before and after compression
+        self._deferred = deque() # tags of the commands not waited for
+        super().__init__(host, port, ssl_context=self.get_ssl_context())
+    
+    @classmethod
+    def get_ssl_context(cls):
+        """Return the SSL context shared by every connection"""
+        with cls._tls_lock:
+            if cls.shared_ssl_context is None:
+                # the same context imaplib creates by default
+                cls.shared_ssl_context = ssl._create_stdlib_context()
+            return cls.shared_ssl_context
+    
+    def _create_socket(self, *args):
+        # imaplib only takes a timeout since Python 3.9
+        sock = socket.create_connection((self.host or None, self.port), 
+                                        self.timeout)
+        if not self.use_ssl:
+            return sock
+        with self._tls_lock:
+            session = self.tls_sessions.get((self.host, self.port))
+        start = time.monotonic()
+        try:
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host, 
+                                                session=session)
+        except:
+            sock.close()
+            raise
+        self.handshake_time = time.monotonic() - start
+        self.session_reused = sock.session_reused
+        return sock
+    
+    def save_tls_session(self):
+        """Keep the TLS session for resuming it in the next connection
+        
+        With TLS 1.3 the session is only available once the server has 
+        sent something after the handshake, e.g. after logging in.
+        """
+        if self.use_ssl and self.sock.session is not None:
+            with self._tls_lock:
+                self.tls_sessions[self.host, self.port] = self.sock.session
+    
+    def open(self, host='', port=imaplib.IMAP4_SSL_PORT, timeout=None):
+        super().open(host, port)
+        self.file = SocketReader(self.sock)
+    
+    def send(self, data):
+        if self.compressor is not None:
+            self.deflated[0] += len(data)
+            data = self.compressor.compress(data) + \
+                   self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.deflated[1] += len(data)
+        self.sent += len(data)
+        super().send(data)
+    
+    def compress(self):
+        """Compress the rest of the connection with DEFLATE (RFC 4978)
+        
+        Return True if the server accepted it.
+        """
+        self._wait_deferred()
+        tag = self._new_tag()
+        self.send(tag + b' COMPRESS DEFLATE' + imaplib.CRLF)
+        typ, data = self._get_tagged_response(tag)
+        if typ != 'OK':
+            return False
+        # the server compresses everything after the response, including 
+        # what could be already read
+        self.compressor = zlib.compressobj(wbits=-15)
+        self.file.decompress()
+        return True
+    
+    def bytes_saved(self):
+        """Return the bytes saved by compression, received and sent"""
+        return self.file.inflated[1] - self.file.inflated[0] + \
+               self.deflated[0] - self.deflated[1]
+    
+    def login(self, user, password):
+        """Log in, updating the capabilities
+        
+        Servers usually announce more capabilities once authenticated, 
+        e.g. CONDSTORE.
+        """
+        typ, data = super().login(user, password)
+        match = self.re_capability_code.match(data[0])
+        if match:
+            capabilities = match.group(1)
+        elif 'CAPABILITY' in self.untagged_responses:
+            capabilities = self.untagged_responses.pop('CAPABILITY')[-1]
+        else:
+            ok, capabilities = self.capability()
+            capabilities = capabilities[-1]
+        self.capabilities = tuple(capabilities.decode().upper().split())
+        return typ, data
+    
+    def close(self):
+        """Close the selected mailbox
+        
+        When pipelining, the response is not waited for, but read along 
+        with the ones of the next command.
+        """
+        if self.pipeline_depth == 1:
+            return super().close()
+        try:
+            self._deferred.append(self._command('CLOSE'))
+        finally:
+            self.state = 'AUTH'
+        return 'OK', [None]
+    
+    def pipeline(self, commands, stream=False):
+        """Run IMAP commands, sending them back to back (RFC 3501, 5.5)
+        
+        'commands' are (name, args, response) tuples, 'response' being the 
+        type of the untagged responses to return, e.g. ('UID', ('SEARCH', 
+        'UNSEEN'), 'SEARCH'). A (type, data) tuple is yielded for every 
+        command, in order, matching the completions by tag. Untagged 
+        responses are returned with the first command completed after 
+        them. BAD responses are returned too, instead of raised.
+        
+        With 'stream' True, every untagged response is yielded as soon as 
+        it's read instead, as a (None, response) tuple, so they don't pile 
+        up in memory.
+        
+        A BAD response to a command sent while others were in flight, 
+        without any of those failing, is taken as the server not coping 
+        with pipelining: the command is sent again alone, and so are the 
+        next ones from then on.
+        """
+        commands = list(commands)
+        sent = deque() # (tag, index of the command, sent while others were)
+        next_index = 0
+        failed = False
+        try:
+            while next_index < len(commands) or sent:
+                while next_index < len(commands) and \
+                      len(sent) < self.pipeline_depth:
+                    name, args, response = commands[next_index]
+                    sent.append((self._send_command(name, args, not sent), 
+                                 next_index, bool(sent)))
+                    next_index += 1
+                tag, index, pipelined = sent.popleft()
+                name, args, response = commands[index]
+                while stream and self.tagged_commands[tag] is None:
+                    self._check_bye()
+                    self._get_response()
+                    for data in self.untagged_responses.pop(response, ()):
+                        yield None, data
+                typ, data = self._complete_command(name, tag)
+                if typ == 'BAD' and pipelined and not failed:
+                    self._drain(sent, commands)
+                    self.pipeline_depth = 1
+                    next_index = index
+                    continue
+                failed = failed or typ != 'OK'
+                if response is not None:
+                    typ, data = self._untagged_response(typ, data, response)
+                yield typ, data
+        except GeneratorExit:
+            self._drain(sent, commands)
+            raise
+    
+    def fetch_stream(self, uid_sets, message_parts):
+        """Fetch messages by UID, yielding the FETCH responses as they're 
+        read
+        
+        A command is pipelined for every UID set. The responses aren't 
+        kept, so memory use doesn't grow with the number of messages. 
+        Responses with a literal are (line, literal) tuples, as in the data 
+        returned by uid().
+        """
+        results = self.pipeline((('UID', ('FETCH', uid_set, message_parts), 
+                                  'FETCH') for uid_set in uid_sets), True)
+        try:
+            for typ, data in results:
+                if typ is None:
+                    yield data
+        finally:
+            results.close()
+    
+    def _send_command(self, name, args, first):
+        """Send a command of a pipeline, return its tag"""
+        if name not in ('SELECT', 'EXAMINE'):
+            return self._command(name, *args)
+        # as select(), but the commands after it are sent before its 
+        # completion
+        if first:
+            self.untagged_responses = {}
+        self.is_readonly = name == 'EXAMINE'
+        tag = self._command(name, *args)
+        self.state = 'SELECTED'
+        return tag
+    
+    def _complete_command(self, name, tag):
+        """Wait for the completion of a command of a pipeline"""
+        self._check_bye()
+        typ, data = self._get_tagged_response(tag)
+        self._check_bye()
+        if name in ('SELECT', 'EXAMINE') and typ != 'OK':
+            self.state = 'AUTH'
+        self._complete_deferred()
+        return typ, data
+    
+    def _drain(self, sent, commands):
+        """Wait for the commands in flight, discarding their responses"""
+        while sent:
+            tag, index, pipelined = sent.popleft()
+            name, args, response = commands[index]
+            while self.tagged_commands[tag] is None:
+                self._check_bye()
+                self._get_response()
+                self.untagged_responses.pop(response, None)
+            self._complete_command(name, tag)
+    
+    def _command_complete(self, name, tag):
+        try:
+            return super()._command_complete(name, tag)
+        finally:
+            self._complete_deferred()
+    
+    def _complete_deferred(self):
+        """Forget the commands not waited for that are already completed"""
+        while self._deferred and \
+              self.tagged_commands.get(self._deferred[0]) is not None:
+            del self.tagged_commands[self._deferred.popleft()]
+    
+    def _wait_deferred(self):
+        while self._deferred:
+            self._get_tagged_response(self._deferred.popleft())
+    
+    def idle(self, timeout, cancel=None):
+        """Wait in IDLE state for new messages in the selected mailbox
+        
+        Return True if the server announced new messages, False if the
+        timeout expired or the 'cancel' event was set.
+        """
+        self._wait_deferred()
+        tag = self._new_tag()
+        self.send(tag + b' IDLE' + imaplib.CRLF)
+        new = False
+        while True:
+            line = self._get_line()
+            if line.startswith(b'+'):
+                break
+            if line.startswith(tag):
+                del self.tagged_commands[tag]
+                raise self.error('IDLE command error: ' + line.decode())
+            new = new or self._is_new_message(line)
+        
+        # cancelling interrupts the connection, waking up the wait
+        end = time.monotonic() + timeout
+        while not new and not (cancel and cancel.is_set()):
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.file.wait(remaining):
+                new = self._is_new_message(self._get_line())
+        
+        self.send(b'DONE' + imaplib.CRLF)
+        while True:
+            line = self._get_line()
+            if line.startswith(tag):
+                break
+            new = new or self._is_new_message(line)
+        del self.tagged_commands[tag]
+        if line.split()[1] != b'OK':
+            raise self.error('IDLE command error: ' + line.decode())
+        return new
+    
+    def list_status(self, status_items, directory='""', pattern='*'):
+        """List mailboxes, returning their STATUS too (RFC 5819)
+        
+        Return (typ, LIST data, STATUS data).
+        """
+        typ, data = self._simple_command('LIST', directory, pattern, 'RETURN', 
+                                         '(STATUS {})'.format(status_items))
+        typ, status_data = self._untagged_response(typ, [None], 'STATUS')
+        typ, list_data = self._untagged_response(typ, data, 'LIST')
+        return typ, list_data, status_data
+    
+    def _is_new_message(self, line):
+        match = self.re_idle_response.match(line)
+        return bool(match) and (match.group(2) == b'EXISTS' or
+                                int(match.group(1)) > 0)
+
+
+class IMAPSession(object):
+    """Authenticated IMAP connection, kept open between checks
+    
+    The connection is tested with NOOP before reusing it, and only 
+    re-established when it's no longer alive. With 'compress' True, it's 
+    compressed if the server supports COMPRESS=DEFLATE. Reads time out 
+    after 'timeout' seconds, so a dead connection fails instead of 
+    blocking.
+    """
+    
+    def __init__(self, hostname, port, user, password, use_ssl=True, 
+                 metrics=None, pipeline_depth=1, compress=True, timeout=None):
+        self.hostname = hostname
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_ssl = use_ssl
+        self.pipeline_depth = pipeline_depth
+        self.compress = compress
+        self.timeout = timeout
+        self.metrics = metrics or NullMetrics()
+        self.account = '{}@{}'.format(user, hostname)
+        self.mail = None
+        self.login_message = None
+        self.connections = 0
+        self.logins = 0
+    
+    def connect(self):
+        """Return an authenticated connection, reconnecting if needed"""
+        if self.mail is not None:
+            try:
+                ok, data = self.mail.noop()
+                if ok == 'OK':
+                    return self.mail
+            except (OSError, imaplib.IMAP4.error):
+                pass
+            self.close()
+        with self.metrics.time('connect', self.account):
+            self.mail = IMAPConnection(self.hostname, self.port, self.use_ssl, 
+                                       self.pipeline_depth, self.timeout)
+        self.connections += 1
+        try:
+            with self.metrics.time('login', self.account, connection=self.mail):
+                ok, message = self.mail.login(self.user, self.password)
+            self.mail.save_tls_session()
+            if self.compress and 'COMPRESS=DEFLATE' in self.mail.capabilities:
+                self.mail.compress()
+        except:
+            self.close()
+            raise
+        self.logins += 1
+        self.login_message = message[0].decode()
+        return self.mail
+    
+    def logout(self):
+        """Log out and close the connection, return the server message"""
+        if self.mail is None:
+            return
+        try:
+            with self.metrics.time('logout', self.account, 
+                                   connection=self.mail):
+                bye, message = self.mail.logout()
+            return message[0].decode()
+        except:
+            pass
+        finally:
+            self.mail = None
+    
+    def close(self):
+        """Close the connection without logging out"""
+        if self.mail is None:
+            return
+        try:
+            self.mail.shutdown()
+        except OSError:
+            pass
+        finally:
+            self.mail = None
+    
+    def interrupt(self):
+        """Abort the command in progress from another thread
+        
+        The socket is shut down, so blocking reads return at once and the 
+        connection fails. The socket is closed later, by the thread using 
+        it.
+        """
+        mail = self.mail
+        if mail is None:
+            return
+        try:
+            # not the SSL shutdown, which isn't thread-safe
+            socket.socket.shutdown(mail.sock, socket.SHUT_RDWR)
+        except (OSError, AttributeError):
+            pass
+
+
+class MailboxFilter(object):
+    """Rules for excluding mailboxes from checking
+    
+    Mailboxes are excluded by decoded name, which can be a glob pattern 
+    with '*' and '?' wildcards, or by flag (case-insensitive). Names are 
+    matched exactly first, so '[Gmail]/Spam' is just a name. Non-selectable 
+    mailboxes are always excluded.
+    """
+    
+    def __init__(self, names, flags):
+        names = [name for name in names if name]
+        patterns = [name for name in names if any(char in name 
+                                                  for char in '*?')]
+        self.names = frozenset(names)
+        self.pattern = None
+        if patterns:
+            self.pattern = re.compile('|'.join(translate_glob(pattern) 
+                                               for pattern in patterns))
+        self.flags = frozenset(flag.lower() for flag in flags if flag) | \
+                     {r'\noselect', r'\nonexistent'}
+    
+    def excludes(self, name, flags=()):
+        return name in self.names or \
+               not self.flags.isdisjoint(flag.lower() for flag in flags) or \
+               bool(self.pattern and self.pattern.match(name))
+
+
+class MessageFilter(object):
+    """Rules for notifying only some of the new messages
+    
+    Messages are only notified if their From contains any of 'senders' 
+    and their Subject matches any of 'subjects', when given, and neither 
+    matches any of 'excluded_senders' or 'excluded_subjects'. Texts are 
+    case-insensitive substrings, except subjects with '*' or '?' wildcards, 
+    which are glob patterns of the whole subject. Messages with an 
+    X-Priority lower than 'min_priority', from 1 (highest) to 5 (lowest), 
+    aren't notified either, a missing one being 3 (normal).
+    
+    The rules that IMAP SEARCH can express, for ASCII texts, are given as 
+    search keys in 'search_criteria', so the messages they exclude aren't 
+    even fetched. Every rule is checked again on the fetched header, as 
+    servers don't match all the same, e.g. by words.
+    """
+    
+    re_wildcards = re.compile(r'[*?]')
+    re_priority = re.compile(r'\s*([1-5])')
+    
+    def __init__(self, senders=(), excluded_senders=(), subjects=(), 
+                 excluded_subjects=(), min_priority=None):
+        self.senders = [sender.lower() for sender in senders if sender]
+        self.excluded_senders = [sender.lower() for sender in 
+                                 excluded_senders if sender]
+        subjects = [subject for subject in subjects if subject]
+        excluded_subjects = [subject for subject in excluded_subjects 
+                             if subject]
+        self.subjects = self._compile(subjects)
+        self.excluded_subjects = self._compile(excluded_subjects)
+        self.min_priority = min_priority
+        self.header_fields = ('X-Priority',) if min_priority else ()
+        
+        keys = []
+        if self.senders:
+            keys.append(self._any([self._key('FROM', sender) 
+                                   for sender in self.senders]))
+        keys.extend(self._key('NOT FROM', sender) 
+                    for sender in self.excluded_senders)
+        if subjects:
+            # patterns are narrowed down by their longest literal text
+            keys.append(self._any([self._key('SUBJECT', 
+                        max(self.re_wildcards.split(subject), key=len)) 
+                        for subject in subjects]))
+        keys.extend(self._key('NOT SUBJECT', subject) 
+                    for subject in excluded_subjects 
+                    if not self.re_wildcards.search(subject))
+        if min_priority:
+            if min_priority >= 3:
+                keys.extend('NOT HEADER X-Priority "{}"'.format(priority) 
+                            for priority in range(min_priority + 1, 6))
+            else:
+                keys.append(self._any(['HEADER X-Priority "{}"'.format(
+                        priority) for priority in range(1, min_priority + 1)]))
+        self.search_criteria = ' '.join(key for key in keys 
+                                        if key is not None)
+    
+    def _compile(self, subjects):
+        if not subjects:
+            return None
+        return re.compile('|'.join(translate_glob(subject) 
+                                   if self.re_wildcards.search(subject) else 
+                                   '(?s:.*{})'.format(re.escape(subject)) 
+                                   for subject in subjects), re.I)
+    
+    def _key(self, name, text):
+        """Return a search key for a text, or None if it isn't ASCII"""
+        if not text or any(not ' ' <= char <= '~' for char in text):
+            return None
+        return '{} "{}"'.format(name, text.replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+    
+    def _any(self, keys):
+        """Return the OR of some search keys, or None if any can't be sent"""
+        if None in keys:
+            return None
+        key = keys[-1]
+        for other_key in reversed(keys[:-1]):
+            key = 'OR {} {}'.format(other_key, key)
+        return key
+    
+    def matches(self, from_, subject, priority=None):
+        """Return True if a message is to be notified"""
+        from_ = (from_ or '').lower()
+        subject = subject or ''
+        if self.senders and not any(sender in from_ 
+                                    for sender in self.senders):
+            return False
+        if any(sender in from_ for sender in self.excluded_senders):
+            return False
+        if self.subjects and not self.subjects.match(subject):
+            return False
+        if self.excluded_subjects and self.excluded_subjects.match(subject):
+            return False
+        if self.min_priority:
+            match = self.re_priority.match(priority or '')
+            if (int(match.group(1)) if match else 3) > self.min_priority:
+                return False
+        return True
+
+
+class HeaderFieldParser(object):
+    """Extract some fields from a message header, without parsing the rest
+    
+    Return a {name: value} dict, with the same values that the 'names'
+    items of a email.parser.BytesHeaderParser message would have: the
+    first of duplicate fields, folded lines kept, None if missing. The
+    raw header can be any bytes-like object, e.g. a memoryview, and it's
+    only scanned, not copied.
+    
+    Headers which are not plain well-formed ASCII, e.g. with 8-bit values
+    or lines that aren't fields, are passed to the stdlib parser instead.
+    """
+    
+    re_field = re.compile(br'([\x21-\x39\x3b-\x7e]+):'
+                          br'([^\r\n]*(?:\r?\n[ \t][^\r\n]*)*)(?:\r?\n|\Z)')
+    re_end = re.compile(br'\r?\n|\Z')
+    
+    def __init__(self, names=('From', 'Subject')):
+        self.names = tuple(names)
+        self._names = {name.lower().encode('ascii'): name for name in names}
+        self.parser = email.parser.BytesHeaderParser()
+        self.fallbacks = 0
+    
+    def __call__(self, raw_header):
+        fields = dict.fromkeys(self.names)
+        missing = len(self._names)
+        pos = 0
+        # a field by match, until every one is found or the header ends
+        while missing:
+            match = self.re_field.match(raw_header, pos)
+            if match is None:
+                if self.re_end.match(raw_header, pos):
+                    break
+                return self._parse(raw_header)
+            pos = match.end()
+            name = self._names.get(match.group(1).lower())
+            if name is not None and fields[name] is None:
+                try:
+                    fields[name] = match.group(2).decode('ascii').lstrip(' \t')
+                except UnicodeDecodeError:
+                    return self._parse(raw_header)
+                missing -= 1
+        return fields
+    
+    def _parse(self, raw_header):
+        self.fallbacks += 1
+        header = self.parser.parsebytes(bytes(raw_header))
+        return {name: header[name] for name in self.names}
+
+
+class StateStore(object):
+    """UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ of every checked mailbox, by 
+    account, and outbox of pending notifications
+    
+    Saved in a SQLite database, or only kept in memory if no path is given.
+    It can be shared between threads. Databases of previous versions are 
+    upgraded by adding the missing columns.
+    """
+    
+    def __init__(self, path=None):
+        self.db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS mailboxes ('
+                            'account TEXT, mailbox BLOB, uidvalidity INTEGER, '
+                            'uidnext INTEGER, PRIMARY KEY (account, mailbox))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                            'id INTEGER PRIMARY KEY, profile TEXT, '
+                            'mailbox TEXT, sender TEXT, subject TEXT)')
+            self._add_column('mailboxes', 'highestmodseq INTEGER')
+            self._add_column('outbox', 'uid INTEGER')
+            self.db.execute('CREATE INDEX IF NOT EXISTS outbox_mailbox '
+                            'ON outbox (profile, mailbox)')
+    
+    def _add_column(self, table, column):
+        """Add a column to a table of an older database, if missing"""
+        columns = [row[1] for row in 
+                   self.db.execute('PRAGMA table_info({})'.format(table))]
+        if column.split()[0] not in columns:
+            self.db.execute('ALTER TABLE {} ADD COLUMN {}'.format(table, 
+                                                                  column))
+    
+    def load(self, account):
+        """Return a {mailbox: (uidvalidity, uidnext, highestmodseq)} dict"""
+        with self.lock:
+            rows = self.db.execute('SELECT mailbox, uidvalidity, uidnext, '
+                                   'highestmodseq FROM mailboxes '
+                                   'WHERE account = ?', (account,)).fetchall()
+        return {bytes(mailbox): (uidvalidity, uidnext, highestmodseq) 
+                for mailbox, uidvalidity, uidnext, highestmodseq in rows}
+    
+    def save(self, account, mailbox, uidvalidity, uidnext, highestmodseq=None):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO mailboxes (account, '
+                            'mailbox, uidvalidity, uidnext, highestmodseq) '
+                            'VALUES (?, ?, ?, ?, ?)', (account, mailbox, 
+                            uidvalidity, uidnext, highestmodseq))
+    
+    def add_notification(self, profile_name, mailbox, from_, subject, 
+                         uid=None):
+        with self.lock, self.db:
+            self.db.execute('INSERT INTO outbox (profile, mailbox, sender, '
+                            'subject, uid) VALUES (?, ?, ?, ?, ?)', 
+                            (profile_name, mailbox, from_, subject, uid))
+    
+    def get_notifications(self, limit):
+        """Return the oldest (id, profile, mailbox, sender, subject) rows"""
+        with self.lock:
+            return self.db.execute('SELECT id, profile, mailbox, sender, '
+                                   'subject FROM outbox ORDER BY id LIMIT ?', 
+                                   (limit,)).fetchall()
+    
+    def delete_notifications(self, ids):
+        """Delete notifications by id, return how many were deleted"""
+        with self.lock, self.db:
+            return self.db.executemany('DELETE FROM outbox WHERE id = ?', 
+                                       [(id_,) for id_ in ids]).rowcount
+    
+    def discard_notifications(self, profile_name, mailbox, uids):
+        """Delete the notifications of some messages, return how many"""
+        with self.lock, self.db:
+            return self.db.executemany('DELETE FROM outbox WHERE profile = ? '
+                                       'AND mailbox = ? AND uid = ?', 
+                                       [(profile_name, mailbox, uid) 
+                                        for uid in uids]).rowcount
+    
+    def get_first_notified(self, profile_name, mailboxes):
+        """Return the lowest UID of the pending notifications of some 
+        mailboxes, or None if there are none"""
+        with self.lock:
+            return self.db.execute('SELECT MIN(uid) FROM outbox WHERE '
+                                   'profile = ? AND mailbox IN ({})'.format(
+                                   ', '.join('?' * len(mailboxes))), 
+                                   [profile_name] + list(mailboxes)
+                                   ).fetchone()[0]
+    
+    def forget_notified_uids(self, profile_name, mailboxes):
+        """Keep the pending notifications of some mailboxes, but not their 
+        UIDs, e.g. after a UIDVALIDITY change"""
+        with self.lock, self.db:
+            self.db.executemany('UPDATE outbox SET uid = NULL WHERE '
+                                'profile = ? AND mailbox = ?', 
+                                [(profile_name, mailbox) 
+                                 for mailbox in mailboxes])
+    
+    def count_notifications(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class NotificationDispatcher(object):
+    """Send notifications from a worker thread, merging bursts of them
+    
+    Notifications are saved to the outbox of a StateStore when received,
+    and deleted from it only once sent, so they survive notifier failures
+    and restarts. Failed sends are retried with an exponential backoff
+    from 'retry' up to 'max_retry' seconds, registering again first.
+    
+    Notifications received within 'window' seconds with the same profile
+    and mailbox or sender ('group_by') are merged into a single one, and
+    no more than 'rate' notifications per second are sent. Up to
+    'queue_size' notifications are queued, the rest are just counted.
+    """
+    
+    group_keys = {'mailbox': 2, 'sender': 3}
+    max_lines = 5
+    
+    def __init__(self, send, outbox, register=None, window=1,
+                 group_by='mailbox', rate=2, queue_size=1000, batch_size=100,
+                 retry=5, max_retry=300, verbose=False):
+        self.send = send
+        self.outbox = outbox
+        self.register = register
+        self.window = window
+        self.group_key = self.group_keys.get(group_by)
+        self.interval = 1 / rate if rate else 0
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.retry = retry
+        self.max_retry = max_retry
+        self.verbose = verbose
+        self.dropped = 0
+        self.failures = 0
+        self.registered = register is None
+        self._pending = self.outbox.count_notifications()
+        self._last_sent = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closing = threading.Event()
+        if self._pending:
+            self._wakeup.set()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def put(self, profile_name, mailbox, from_, subject, uid=None):
+        """Queue a notification"""
+        with self._lock:
+            if self._pending >= self.queue_size:
+                self.dropped += 1
+            else:
+                self.outbox.add_notification(profile_name, mailbox, from_,
+                                             subject, uid)
+                self._pending += 1
+        self._wakeup.set()
+    
+    def discard(self, profile_name, mailbox, uids):
+        """Drop the queued notifications of some messages, e.g. read since"""
+        with self._lock:
+            self._pending -= self.outbox.discard_notifications(profile_name,
+                                                               mailbox, uids)
+    
+    def close(self, timeout=None):
+        """Try to send the queued notifications and stop"""
+        self._closing.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+    
+    def _run(self):
+        while not self._closing.is_set():
+            self._wakeup.wait()
+            # let the burst come in
+            self._closing.wait(self.window)
+            self._wakeup.clear()
+            while not self._deliver():
+                delay = min(self.retry * 2 ** (self.failures - 1),
+                            self.max_retry)
+                if self.verbose:
+                    print('\nretrying notifications in {} s'.format(delay))
+                if self._closing.wait(delay):
+                    break
+        if not self.failures:
+            self._deliver()
+    
+    def _deliver(self):
+        """Send every notification in the outbox, return False on failure"""
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+            if dropped:
+                self.outbox.add_notification(None, None, None,
+                                        '{} more new emails'.format(dropped))
+                self._pending += 1
+        while True:
+            batch = self.outbox.get_notifications(self.batch_size)
+            if not batch:
+                return True
+            for ids, profile_name, title, description in self._merge(batch):
+                if not self._send(profile_name, title, description):
+                    return False
+                with self._lock:
+                    self._pending -= self.outbox.delete_notifications(ids)
+    
+    def _merge(self, batch):
+        """Return (ids, profile name, title, description) notifications"""
+        groups = OrderedDict()
+        for item in batch:
+            if self.group_key is None or item[1] is None:
+                key = item
+            else:
+                key = item[1], item[self.group_key]
+            groups.setdefault(key, []).append(item)
+        notifications = []
+        for key, items in groups.items():
+            ids = [item[0] for item in items]
+            id_, profile_name, mailbox, from_, subject = items[0]
+            if profile_name is None: # count of dropped notifications
+                notifications.append((ids, None, subject, ''))
+            elif len(items) == 1:
+                notifications.append((ids, profile_name, from_, subject))
+            else:
+                if self.group_key == 3:
+                    title = from_
+                    lines = [item[4] for item in items]
+                else:
+                    title = '{} new emails in {}'.format(len(items), mailbox)
+                    lines = ['{}: {}'.format(item[3], item[4])
+                             for item in items]
+                if len(lines) > self.max_lines:
+                    lines[self.max_lines:] = ['...']
+                notifications.append((ids, profile_name, title,
+                                      '\n'.join(lines)))
+        return notifications
+    
+    def _send(self, profile_name, title, description):
+        """Send a notification, return False on failure"""
+        delay = self._last_sent + self.interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._last_sent = time.monotonic()
+        try:
+            if not self.registered:
+                self.register()
+                self.registered = True
+            # gntp returns the error instead of True on error responses
+            result = self.send(title, description, profile_name)
+            if result is not True:
+                raise RuntimeError(result)
+        except Exception as err:
+            if self.verbose:
+                print('\nnotification error:', err)
+            self.failures += 1
+            self.registered = self.register is None
+            return False
+        self.failures = 0
+        return True
+
+
+class WorkerDispatcher(object):
+    """Notification dispatcher of a worker process of a Supervisor
+    
+    Notifications are passed on to the supervisor process.
+    """
+    
+    def __init__(self, results):
+        self.results = results
+    
+    def put(self, profile_name, mailbox, from_, subject, uid=None):
+        self.results.put(('notification', profile_name, mailbox, from_, 
+                          subject, uid))
+    
+    def discard(self, profile_name, mailbox, uids):
+        self.results.put(('discard', profile_name, mailbox, uids))
+    
+    def close(self, timeout=None):
+        pass
+
+
+class Metrics(object):
+    """Latency histograms, counts, bytes and errors of the check phases
+    
+    Phases are recorded by account and mailbox (empty for the account 
+    phases: connect, login, list, logout). They can be served in the 
+    Prometheus text format over HTTP and dumped periodically as JSON.
+    """
+    
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    def __init__(self):
+        self._phases = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._dump_path = None
+        self._closing = threading.Event()
+    
+    def time(self, phase, account, mailbox='', connection=None):
+        """Return a context manager recording a phase
+        
+        The bytes transferred through 'connection' are recorded too, and 
+        an error when an exception is raised or 'error' is set.
+        """
+        return PhaseTimer(self, phase, account, mailbox, connection)
+    
+    def record(self, phase, account, mailbox, seconds, received=0, sent=0, 
+               error=False):
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self._phases.get((phase, account, mailbox))
+            if values is None:
+                # count, sum, received, sent, errors, buckets
+                values = [0, 0, 0, 0, 0] + [0] * (len(self.buckets) + 1)
+                self._phases[phase, account, mailbox] = values
+            values[0] += 1
+            values[1] += seconds
+            values[2] += received
+            values[3] += sent
+            values[4] += error
+            values[5 + bucket] += 1
+    
+    def take(self):
+        """Return the raw values recorded, and start over"""
+        with self._lock:
+            phases, self._phases = self._phases, {}
+        return phases
+    
+    def add(self, phases):
+        """Add raw values returned by take(), e.g. from another process"""
+        with self._lock:
+            for key, values in phases.items():
+                current = self._phases.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    current[i] += value
+    
+    def get_phases(self):
+        """Return a list of dicts, one by phase, account and mailbox"""
+        with self._lock:
+            phases = [(key, list(values)) 
+                      for key, values in self._phases.items()]
+        result = []
+        for (phase, account, mailbox), values in sorted(phases):
+            buckets = OrderedDict()
+            count = 0
+            for le, bucket_count in zip(self.buckets + ('+Inf',), 
+                                        values[5:]):
+                count += bucket_count
+                buckets[str(le)] = count
+            result.append(OrderedDict([('phase', phase), 
+                ('account', account), ('mailbox', mailbox), 
+                ('count', values[0]), ('seconds', values[1]), 
+                ('bytes_received', values[2]), ('bytes_sent', values[3]), 
+                ('errors', values[4]), ('buckets', buckets)]))
+        return result
+    
+    def prometheus_text(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        prefix = 'email_checker_phase_'
+        lines = [
+            '# HELP {}seconds Duration of the check phases.'.format(prefix), 
+            '# TYPE {}seconds histogram'.format(prefix)]
+        counters = []
+        for phase in self.get_phases():
+            labels = ','.join('{}="{}"'.format(key, phase[key].replace(
+                              '\\', r'\\').replace('"', r'\"').replace(
+                              '\n', r'\n')) 
+                              for key in ('phase', 'account', 'mailbox'))
+            for le, count in phase['buckets'].items():
+                lines.append('{}seconds_bucket{{{},le="{}"}} {}'.format(
+                             prefix, labels, le, count))
+            lines.append('{}seconds_sum{{{}}} {}'.format(prefix, labels, 
+                                                         phase['seconds']))
+            lines.append('{}seconds_count{{{}}} {}'.format(prefix, labels, 
+                                                           phase['count']))
+            counters.append((labels, phase))
+        for name, key, help in (
+                ('bytes_received_total', 'bytes_received', 'Bytes received'), 
+                ('bytes_sent_total', 'bytes_sent', 'Bytes sent'), 
+                ('errors_total', 'errors', 'Failed check phases')):
+            lines.append('# HELP {}{} {}.'.format(prefix, name, help))
+            lines.append('# TYPE {}{} counter'.format(prefix, name))
+            for labels, phase in counters:
+                lines.append('{}{}{{{}}} {}'.format(prefix, name, labels, 
+                                                    phase[key]))
+        return '\n'.join(lines) + '\n'
+    
+    def serve(self, address, port):
+        """Serve the Prometheus text format over HTTP from a thread"""
+        self._server = http.server.HTTPServer((address, port), 
+                                              MetricsRequestHandler)
+        self._server.metrics = self
+        threading.Thread(target=self._server.serve_forever, 
+                         daemon=True).start()
+    
+    def dump_periodically(self, path, interval):
+        """Write the metrics as JSON every 'interval' seconds, from a thread"""
+        self._dump_path = path
+        def dump_loop():
+            while not self._closing.wait(interval):
+                self.dump()
+        threading.Thread(target=dump_loop, daemon=True).start()
+    
+    def dump(self):
+        data = OrderedDict([
+            ('time', datetime.now(timezone.utc).astimezone().isoformat()), 
+            ('phases', self.get_phases())])
+        temp_path = self._dump_path + '.tmp'
+        with open(temp_path, 'w') as dump_file:
+            json.dump(data, dump_file, indent=1)
+        os.replace(temp_path, self._dump_path)
+    
+    def close(self):
+        """Stop serving, and dump the metrics a last time"""
+        self._closing.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._dump_path is not None:
+            self.dump()
+
+
+class NullMetrics(object):
+    """Metrics replacement doing nothing, when they're disabled"""
+    
+    def time(self, phase, account, mailbox='', connection=None):
+        return null_timer
+    
+    def record(self, *args, **kwargs):
+        pass
+    
+    def close(self):
+        pass
+
+
+class PhaseTimer(object):
+    
+    def __init__(self, metrics, phase, account, mailbox, connection):
+        self.metrics = metrics
+        self.phase = phase
+        self.account = account
+        self.mailbox = mailbox
+        self.connection = connection
+        self.error = False
+    
+    def __enter__(self):
+        if self.connection is not None:
+            self.received = self.connection.file.received
+            self.sent = self.connection.sent
+        self.start = time.monotonic()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.monotonic() - self.start
+        received = sent = 0
+        if self.connection is not None:
+            received = self.connection.file.received - self.received
+            sent = self.connection.sent - self.sent
+        self.metrics.record(self.phase, self.account, self.mailbox, seconds, 
+                            received, sent, self.error or exc_type is not None)
+
+
+class NullTimer(object):
+    
+    error = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+null_timer = NullTimer()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    """Handler of the control socket: a JSON line answers every command"""
+    
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode('utf-8', 'replace').strip()
+            if command:
+                reply = self.server.checker.control(command)
+                self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class SocketReader(object):
+    """Buffered reader of a socket which can wait for incoming data
+    
+    Replacement for the file object of imaplib connections.
+    """
+    
+    def __init__(self, sock, bufsize=65536):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buffer = bytearray()
+        self.received = 0
+        self.decompressor = None
+        self.inflated = [0, 0] # bytes received, before and after inflating
+    
+    def decompress(self):
+        """Inflate the data from now on, including the already buffered"""
+        self.decompressor = zlib.decompressobj(wbits=-15)
+        data, self.buffer = self.buffer, bytearray()
+        self._add(bytes(data))
+    
+    def _fill(self):
+        try:
+            data = self.sock.recv(self.bufsize)
+        except socket.timeout:
+            raise imaplib.IMAP4.abort('socket error: timed out')
+        self.received += len(data)
+        self._add(data)
+        return bool(data)
+    
+    def _add(self, data):
+        if self.decompressor is not None:
+            self.inflated[0] += len(data)
+            data = self.decompressor.decompress(data)
+            self.inflated[1] += len(data)
+        self.buffer += data
+    
+    def readline(self, limit=-1):
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start) + 1
+            if end:
+                break
+            start = len(self.buffer)
+            if 0 <= limit <= start or not self._fill():
+                end = start
+                break
+        if 0 <= limit < end:
+            end = limit
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+    
+    def read(self, size):
+        while len(self.buffer) < size and self._fill():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+    
+    def wait(self, timeout=None):
+        """Return True if there is data ready to be read before the timeout"""
+        if self.buffer or (hasattr(self.sock, 'pending') and
+                           self.sock.pending()):
+            return True
+        return bool(select.select([self.sock], [], [], timeout)[0])
+    
+    def close(self):
+        pass
+
+
 class EmailChecker(object):
     
-    pause, pause_internal, resume, resume_internal, exit, error = range(6)
+    (pause, pause_internal, resume, resume_internal, exit, error, check_now, 
+     reload) = range(8)
+    control_commands = {'check-now': check_now, 'pause': pause, 
+                        'resume': resume, 'reload-config': reload, 
+                        'exit': exit}
+    
+    # Gmail labels of the special-use mailboxes, by flag
+    gmail_flag_labels = {r'\sent': r'\Sent', r'\important': r'\Important', 
+                         r'\flagged': r'\Starred', r'\drafts': r'\Draft', 
+                         r'\junk': r'\Spam', r'\trash': r'\Trash'}
     
-    def __init__(self, config_path=None):
-        self.config = configparser.ConfigParser(
+    def __init__(self, config_path=None, config=None, profile=None):
+        if config is not None:
+            # share an already read configuration
+            self.config = config
+            self.profile = self.config[profile or 
+                                       self.config['general']['profile']]
+        else:
+            self.config = configparser.ConfigParser(
                                 default_section='default', allow_no_value=True)
-        self.config['general'] = {'config_path': 'settings.ini'}
-        if config_path is not None:
-            self.read_config(config_path)
-        self.uid_dict = defaultdict(int) # TODO: UIDVALIDITY
+            self.config['general'] = {'config_path': 'settings.ini'}
+            if config_path is not None:
+                self.read_config(config_path)
+        self.uid_dict = None
+        self.state = None
         self.re_list_response = re.compile(br'\((.*?)\)\s+"(.*?)"\s+(.*)')
-        self.parse_header = email.parser.BytesHeaderParser().parsebytes
+        self.re_status_response = re.compile(br'(.*?)\s*\(([^()]*)\)\s*$')
+        self.re_fetch_uid = re.compile(br'UID (\d+)')
+        self.re_fetch_thread = re.compile(br'X-GM-THRID (\d+)')
+        self.re_fetch_labels = re.compile(
+                        br'X-GM-LABELS \(((?:[^()"]|"(?:[^"\\]|\\.)*")*)\)')
+        self.re_label = re.compile(br'"((?:[^"\\]|\\.)*)"|([^\s"]+)')
+        self.status_items = '(UIDNEXT UIDVALIDITY UNSEEN)'
+        self.fetch_items = ('(BODY.PEEK[HEADER.FIELDS '
+                            '(FROM SUBJECT DATE MESSAGE-ID)])')
+        self._listed_status = {}
+        self._mailboxes = None
+        self._list_lines = {}
+        self._all_mail = None
+        self._gmail_labels = {}
+        self._list_expiry = 0
+        self.parse_header = HeaderFieldParser(('From', 'Subject'))
+        self.message_filter = MessageFilter()
+        self.session = None
+        self.dispatcher = None
+        self.metrics = NullMetrics()
+        self._schedule = {}
+        self._last_checks = {} # mailbox: (time, seconds, new messages)
+        self._last_cycle = None
+        self._notified = 0
+        self._failures = 0
+        self._last_error = None # (time, error)
+        self._activity = None
+        self._paused = False
+        self.control_command = None
+        self._control_server = None
         self._check_thread = None
         self._power_thread = None
         self._cancel = threading.Event()
         self._cancel_all = threading.Event()
+        self._queue = queue.Queue()
     
     def parse_command_line(self):
         epilog = 'Latest version: <{url}>\n\nLicense: {license}'.format(
@@ -121,49 +1386,299 @@ def parse_command_line(self):
                             help='specify a custom settings file path')
         parser.add_argument('-p', '--profile', 
                             help='choose a profile from the settings file')
+        parser.add_argument('-a', '--all', action='store_true', 
+                            help='check every profile from the settings file')
+        parser.add_argument('-w', '--workers', type=int, 
+                            help='check every profile, split between a '
+                                 'number of processes')
         parser.add_argument('-u', '--user', help='specify the user')
         parser.add_argument('-x', '--pass', help='specify the password', 
                             dest='pass_', metavar='PASS')
+        parser.add_argument('-c', '--control', metavar='COMMAND', 
+                            choices=['status'] + sorted(self.control_commands), 
+                            help='send a command to the running instance: '
+                                 '%(choices)s')
         args = parser.parse_args()
         self.read_config(args.settings)
-        self.config['general']['verbose'] = str(args.verbose or __debug__)
+        self.control_command = args.control
+        # kept for reloading the settings
+        overrides = [('general', 'verbose', str(args.verbose or __debug__))]
+        if args.all:
+            overrides.append(('general', 'all_profiles', 'yes'))
+        if args.workers is not None:
+            overrides.append(('general', 'workers', str(args.workers)))
         if args.profile is not None:
-            self.config['general']['profile'] = args.profile
-            self.profile = self.config[args.profile]
+            overrides.append(('general', 'profile', args.profile))
+        profile = args.profile or self.config['general']['profile']
         if args.user is not None:
-            self.profile['user_id'] = args.user
+            overrides.append((profile, 'user_id', args.user))
         if args.pass_ is not None:
-            self.profile['password'] = args.pass_
+            overrides.append((profile, 'password', args.pass_))
+        self.config.overrides = overrides
+        self._apply_overrides()
+    
+    def _apply_overrides(self):
+        """Apply the settings from the command line"""
+        for section, key, value in getattr(self.config, 'overrides', ()):
+            self.config[section][key] = value
+        self.profile = self.config[self.config['general']['profile']]
+    
+    def reload_config(self):
+        """Read the settings files again, keeping the command line settings
+        
+        Profiles and excluded mailboxes are updated, and the accounts 
+        connect again. Notification, metrics and control settings are only 
+        read when starting.
+        
+        If the settings can't be read, the current ones are kept, and False 
+        is returned.
+        """
+        account = self._get_account()
+        try:
+            config = self._load_config()
+        except Exception as err:
+            err_str = 'unable to reload the settings: ' + \
+                      self._format_error(err)
+            print(err_str)
+            self._last_error = time.time(), err_str
+            return False
+        self.config = config
+        self.profile = self.config[self.config['general']['profile']]
+        self._logout(self.config['general'].getboolean('verbose'))
+        self.session = None
+        self._list_lines = {}
+        self._all_mail = None
+        self._refresh_mailboxes()
+        if self._get_account() != account:
+            self.uid_dict = None
+            self._schedule.clear()
+            self._last_checks.clear()
+        return True
+    
+    def _load_config(self):
+        """Read the settings files again into a new configuration, keeping 
+        the command line settings"""
+        config = configparser.ConfigParser(default_section='default', 
+                                           allow_no_value=True)
+        config['general'] = {
+                        'config_path': self.config['general']['config_path']}
+        config.overrides = getattr(self.config, 'overrides', ())
+        self._read_config(config)
+        for section, key, value in config.overrides:
+            config[section][key] = value
+        config[config['general']['profile']] # fails if missing
+        return config
     
-    def read_config(self, config_path=None):
-        if config_path is not None:
-            self.config['general']['config_path'] = config_path
-        self.config.read(self.config['general']['config_path'])
+    def read_config(self, config_path=None, config_string=None):
+        """Read the settings file, and the files of 'profiles_dir'
+        
+        The settings can be given as a string instead.
+        """
+        self._read_config(self.config, config_path, config_string)
         self.profile = self.config[self.config['general']['profile']]
-        self.config.excluded_mailboxes_names = \
-            self.config['excluded mailboxes / names'].values()
-        self.config.excluded_mailboxes_flags = \
-            self.config['excluded mailboxes / flags'].values()
+    
+    def _read_config(self, config, config_path=None, config_string=None):
+        if config_string is not None:
+            config.read_string(config_string)
+        else:
+            if config_path is not None:
+                config['general']['config_path'] = config_path
+            config.read(config['general']['config_path'])
+            profiles_dir = config['general'].get('profiles_dir')
+            if profiles_dir:
+                config.read(sorted(glob.glob(
+                                        os.path.join(profiles_dir, '*.ini'))))
+        config.mailbox_filter = MailboxFilter(
+            self._get_section_values(config, 'excluded mailboxes / names'), 
+            self._get_section_values(config, 'excluded mailboxes / flags'))
         if __debug__: # always show info with no python -O flag
-            self.config['general']['verbose'] = 'yes'
+            config['general']['verbose'] = 'yes'
+    
+    def _get_section_values(self, config, section):
+        """Return the values of a section, excluding the default ones"""
+        defaults = config.defaults()
+        return [value for key, value in config[section].items() 
+                if key not in defaults]
     
     def register_gntp(self):
+        """Set up the GNTP notifier
+        
+        Registration is done, and retried while failing, by the 
+        notification dispatcher.
+        """
         self.growl_notifier = gntp.notifier.GrowlNotifier(
             applicationName=self.config['general']['profile'],
             notifications=['New email'],
             defaultNotifications=['New email'],
-            applicationIcon=self._get_icon())
-        self.growl_notifier.register()
+            applicationIcon=self._get_icon(),
+            **self._get_growl_address())
+        self._start_dispatcher()
+    
+    def _get_growl_address(self):
+        general = self.config['general']
+        return dict(hostname=general['growl_hostname'], 
+                    port=general.getint('growl_port'), 
+                    password=general['growl_password'] or None)
+    
+    def _start_dispatcher(self):
+        general = self.config['general']
+        self._open_state()
+        self.dispatcher = NotificationDispatcher(self.notify, self.state, 
+            register=self.growl_notifier.register, 
+            window=general.getfloat('notification_window'), 
+            group_by=general['notification_grouping'], 
+            rate=general.getfloat('notification_rate'), 
+            queue_size=general.getint('notification_queue_size'), 
+            batch_size=general.getint('notification_batch_size'), 
+            retry=general.getfloat('notification_retry'), 
+            max_retry=general.getfloat('notification_max_retry'), 
+            verbose=general.getboolean('verbose'))
     
-    def _get_icon(self):
+    def start_metrics(self):
+        """Record the check phases, if enabled in the settings
+        
+        They're served in the Prometheus format on 'metrics_port', and/or 
+        dumped as JSON to 'metrics_json' every 'metrics_interval' seconds.
+        """
+        general = self.config['general']
+        port = general.get('metrics_port')
+        path = general.get('metrics_json')
+        if not port and not path:
+            return
+        self.metrics = Metrics()
+        if port:
+            self.metrics.serve(general.get('metrics_address') or 'localhost', 
+                               int(port))
+        if path:
+            self.metrics.dump_periodically(path, 
+                                general.getfloat('metrics_interval', 60))
+    
+    def start_control(self):
+        """Listen for commands on the 'control_socket' Unix socket, if set
+        
+        Every command is a line, answered with a line of JSON: check-now, 
+        pause, resume, reload-config, exit, and status, which returns the 
+        state of every mailbox and the timings of their last checks.
+        """
+        path = self.config['general'].get('control_socket')
+        if not path:
+            return
+        if not hasattr(socketserver, 'UnixStreamServer'):
+            raise SystemExit('control sockets not supported on this system')
+        if os.path.exists(path):
+            # left by an instance that didn't exit cleanly, or in use
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise SystemExit('control_socket is not a socket: ' + path)
+            try:
+                send_control_command(path, 'status')
+            except (OSError, ValueError):
+                os.remove(path)
+            else:
+                raise SystemExit('control socket in use: ' + path)
+        # only the user can connect, from the start: changing the mode 
+        # after binding leaves a window for other users to connect
+        umask = os.umask(0o177)
+        try:
+            self._control_server = socketserver.ThreadingUnixStreamServer(
+                                                path, ControlRequestHandler)
+        finally:
+            os.umask(umask)
+        self._control_server.daemon_threads = True
+        self._control_server.checker = self
+        threading.Thread(target=self._control_server.serve_forever, 
+                         daemon=True).start()
+    
+    def _close_control(self):
+        if self._control_server is None:
+            return
+        self._control_server.shutdown()
+        self._control_server.server_close()
+        try:
+            os.remove(self._control_server.server_address)
+        except OSError:
+            pass
+        self._control_server = None
+    
+    def control(self, command):
+        """Run a command from the control socket, return the reply"""
+        if command == 'status':
+            return OrderedDict([('ok', True), ('status', self.get_status())])
+        item = self.control_commands.get(command)
+        if item is None:
+            return {'ok': False, 'error': 'unknown command: ' + command}
+        if item == self.check_now and self._paused:
+            return {'ok': False, 'error': 'paused'}
+        if item == self.reload:
+            # read again when reloading, but the errors are replied now
+            try:
+                self._load_config()
+            except Exception as err:
+                return {'ok': False, 'error': 'unable to reload the settings: ' 
+                                              + self._format_error(err)}
+        self._queue.put(item)
+        return {'ok': True}
+    
+    def get_status(self):
+        """Return the state of the checker and of every mailbox"""
+        now = time.monotonic()
+        uid_dict = dict(self.uid_dict or {})
+        schedule = dict(self._schedule)
+        last_checks = dict(self._last_checks)
+        mailboxes = OrderedDict()
+        for mailbox in sorted(set(uid_dict).union(schedule, last_checks)):
+            status = OrderedDict()
+            if mailbox in uid_dict:
+                status['uidvalidity'], status['uidnext'], \
+                status['highestmodseq'] = uid_dict[mailbox]
+            if mailbox in schedule:
+                due, rate, last_check = schedule[mailbox]
+                status['next_check'] = max(due - now, 0)
+                status['rate'] = rate
+            if mailbox in last_checks:
+                checked, seconds, new_messages = last_checks[mailbox]
+                status['last_check'] = format_time(checked)
+                status['last_check_seconds'] = seconds
+                status['new_messages'] = new_messages
+            mailboxes[decode_imap_utf7(mailbox.strip(b'"'))] = status
+        last_cycle = None
+        if self._last_cycle is not None:
+            checked, seconds, checked_mailboxes = self._last_cycle
+            last_cycle = OrderedDict([('time', format_time(checked)), 
+                                      ('seconds', seconds), 
+                                      ('mailboxes', checked_mailboxes)])
+        session = self.session
+        return OrderedDict([
+            ('profile', self.profile.name), 
+            ('state', self._get_state_name()), 
+            ('connected', session is not None and session.mail is not None), 
+            ('notified', self._notified), 
+            ('last_check', last_cycle), 
+            ('last_error', self._last_error and OrderedDict([
+                ('time', format_time(self._last_error[0])), 
+                ('error', self._last_error[1])])), 
+            ('mailboxes', mailboxes)])
+    
+    def _get_state_name(self):
+        if self._paused:
+            return 'paused'
+        return self._activity or 'waiting'
+    
+    def _close_dispatcher(self):
+        """Wait for the pending notifications to be sent"""
+        if self.dispatcher is not None:
+            self.dispatcher.close(10)
+    
+    def _get_icon(self, profile=None):
         """gntp library only admits http:// URIs and binary data"""
-        if os.path.isfile(self.profile['icon']):
-            with open(self.profile['icon'], 'rb') as icon_file:
+        if profile is None:
+            profile = self.profile
+        if os.path.isfile(profile['icon']):
+            with open(profile['icon'], 'rb') as icon_file:
                 return icon_file.read()
         else:
-            return self.profile['icon']
+            return profile['icon']
     
-    def notify(self, title, description):
+    def notify(self, title, description, profile_name=None):
         return self.growl_notifier.notify('New email', title, description, 
                                           sticky=self.profile['sticky'], 
                                           priority=1, 
@@ -191,143 +1706,729 @@ def check(self, period=None, power=False):
         self._check_thread = threading.Thread(
                                             target=self._do_check, daemon=True)
         self._check_thread.start()
-    
-    def _do_check(self, retry=True):
-        verbose = self.config['general'].getboolean('verbose')
-        if verbose:
-            print('\n\nchecking...', datetime.now(timezone.utc).astimezone())
-        try:
-            # log in
-            self.mail = imaplib.IMAP4_SSL(self.profile['hostname'], 
-                                          int(self.profile['port']))
-            ok, message = self.mail.login(self.profile['user_id'], 
-                                          self.profile['password'])
-            if verbose:
-                print('\n' + message[0].decode() + '\n')
-            if self._cancel.is_set():
-                return
-            
-            # check every mailbox
-            if 'IDLE' in self.mail.capabilities:
-                pass # not supported in Outlook
-            ok, mblist = self.mail.list()
-            for mailbox in mblist:
-                if self._cancel.is_set():
-                    break
-                
-                # select mailbox, if it's not excluded
-                flags, delimiter, mailbox = self._parse_list_response(mailbox)
-                for flag in flags:
-                    if flag in self.config.excluded_mailboxes_flags or \
-                       flag == r'\Noselect':
-                            continue_ = True
-                            break
-                else: continue_ = False
-                if continue_ or decode_imap_utf7(mailbox.strip(b'"')) in \
-                        self.config.excluded_mailboxes_names:
-                    continue
-                ok, data = self.mail.select(mailbox, readonly=True)
-                
-                # search for new unread messages
-                # UIDNEXT is the starting UID for the next check
-                uidnext = self.uid_dict[mailbox]
-                ok, new_uidnext = self.mail.response('UIDNEXT')
-                self.uid_dict[mailbox] = int(new_uidnext[0])
-                if uidnext:
-                    search_criteria = '(UNSEEN UID {}:*)'.format(uidnext)
-                else:
-                    search_criteria = '(UNSEEN)'
-                ok, data = self.mail.uid('SEARCH', None, search_criteria)
-                if self._cancel.is_set():
-                    self.mail.close()
-                    break
-                uids = data[0].decode().split()
-                if uids and int(uids[-1]) < uidnext: # because IMAP
-                    uids = []
-                if verbose:
-                    print(decode_imap_utf7(mailbox.strip(b'"')), uidnext, 
-                          [int(i) for i in uids])
-                if not uids:
-                    self.mail.close()
-                    continue
-                
-                # parse headers for 'From' and 'Subject' and 
-                # notify Growl about the new messages
-                ok, data = self.mail.uid('FETCH', '{}:*'.format(uids[0]), 
-                                         '(BODY.PEEK[HEADER])')
-                if verbose: print('')
-                for header in data[::2]:
-                    if self._cancel.is_set():
-                        self.mail.close()
-                        break
-                    header = self.parse_header(header[1])
-                    from_ = self._decode_header(header['From'])
-                    subject = self._decode_header(header['Subject'])
-                    if verbose:
-                        print('From: {}\nSubject: {}\n'.format(from_, subject))
-                    self.notify(from_, subject)
-                else:
-                    self.mail.close()
-                    continue
-                break
-            
-            # log out
-            try:
-                bye, message = self.mail.logout()
-                if verbose:
-                    print('\n' + message[0].decode())
-            except:
-                pass
-            if self._cancel.is_set():
+    
+    def _do_check(self):
+        verbose = self.config['general'].getboolean('verbose')
+        if verbose:
+            print('\n\nchecking...', datetime.now(timezone.utc).astimezone())
+        try:
+            if not self._check_cycle(verbose):
+                self._logout(verbose)
                 return
+            self._failures = 0
+            self._last_error = None
             
             # schedule a new check
             try:
                 period = self.profile.getboolean('period')
             except ValueError:
                 period = True
+            idle_mailbox = None
+            if period and not self._cancel.is_set():
+                # wait for new messages in the IDLE mailbox until the next 
+                # check of a mailbox is due. Not supported in Outlook
+                idle_mailbox = self._get_idle_mailbox()
+                if idle_mailbox is not None:
+                    self._idle(idle_mailbox, self._get_next_check_delay(), 
+                               verbose)
+            
+            # log out only when done, the connection is kept between checks
+            if self._cancel.is_set() or not period:
+                self._logout(verbose)
+            if self._cancel.is_set():
+                return
+            
             if period:
-                self._check_thread = threading.Timer(self.profile.getint('period'), 
-                                               self._do_check)
-                self._check_thread.daemon = True
-                self._check_thread.start()
+                if idle_mailbox is not None:
+                    delay = 0
+                else:
+                    delay = self._get_next_check_delay()
+                self._schedule_check(delay)
             else:
                 self._queue.put(self.exit)
         
         except Exception as err:
-            match = re.match(r"<class '(.+)'>", repr(type(err)))
-            name = match.group(1) if match else type(err).__name__
-            err_str = '{}: {}'.format(name, str(err))
-            # retry once if the conection was aborted, else exit with error
-            if isinstance(err, (OSError, imaplib.IMAP4.abort)) and retry:
+            if self._cancel.is_set(): # interrupted by cancel()
+                if self.session is not None:
+                    self.session.close()
+                return
+            err_str = self._format_error(err)
+            # reconnect if the conection was aborted, else exit with error
+            if isinstance(err, (OSError, imaplib.IMAP4.abort)) and \
+               not self._cancel.is_set():
+                self._failures += 1
+                self._last_error = time.time(), err_str
+                delay = self._get_retry_delay(self._failures)
                 if verbose:
-                    print(err_str)
-                time.sleep(10)
-                return self._do_check(retry=False)
-            try:
-                self.mail.logout()
-            except:
-                pass
+                    print('{}\nretrying in {:.0f} s'.format(err_str, delay))
+                if self.session is not None:
+                    self.session.close()
+                self._schedule_check(delay)
+                return
+            self._logout(verbose)
             self._queue.put(self.error)
             self._queue.put(err_str)
     
+    def _schedule_check(self, delay):
+        self._check_thread = threading.Timer(delay, self._do_check)
+        self._check_thread.daemon = True
+        self._check_thread.start()
+    
+    def _get_retry_delay(self, failures):
+        """Return the seconds to wait before reconnecting
+        
+        The delay doubles with every consecutive failure, from 
+        'retry_delay' up to 'max_retry_delay' seconds, and a random part 
+        of up to half of it is removed, so that clients failing at the 
+        same time don't reconnect at the same time too.
+        """
+        delay = min(self.profile.getfloat('retry_delay') * 
+                    2 ** min(failures - 1, 30), 
+                    self.profile.getfloat('max_retry_delay'))
+        return random.uniform(delay / 2, delay)
+    
+    def _format_error(self, err):
+        match = re.match(r"<class '(.+)'>", repr(type(err)))
+        name = match.group(1) if match else type(err).__name__
+        return '{}: {}'.format(name, str(err))
+    
+    def _get_account(self):
+        return '{}@{}'.format(self.profile['user_id'], self.profile['hostname'])
+    
+    def _open_state(self):
+        """Open the state store and load the account state, if not done yet"""
+        if self.state is None:
+            self.state = StateStore(self.config['general'].get('state_path'))
+        if self.uid_dict is None:
+            self.uid_dict = self.state.load(self._get_account())
+    
+    def _connect(self, verbose):
+        """Log in, reusing the connection from the previous check if alive"""
+        self._open_state()
+        if self.session is None:
+            self._set_message_filter()
+            self.session = IMAPSession(self.profile['hostname'], 
+                                       int(self.profile['port']), 
+                                       self.profile['user_id'], 
+                                       self.profile['password'], 
+                                       self.profile.getboolean('ssl', True), 
+                                       self.metrics, 
+                                       self.profile.getint('pipeline_depth', 1), 
+                                       self.profile.getboolean('compress', True), 
+                                       self.profile.getfloat('timeout', 60) 
+                                       or None)
+        logins = self.session.logins
+        self.mail = self.session.connect()
+        if verbose:
+            if self.session.logins != logins:
+                print('\n' + self.session.login_message)
+                if self.mail.handshake_time is not None:
+                    print('TLS handshake: {:.0f} ms{}'.format(
+                          self.mail.handshake_time * 1000, 
+                          ' (resumed)' if self.mail.session_reused else ''))
+            print('\nconnections: {}, logins: {}'.format(
+                  self.session.connections, self.session.logins))
+            if self.mail.compressor is not None:
+                print('compression: {} bytes saved'.format(
+                      self.mail.bytes_saved()))
+            print('')
+    
+    def _set_message_filter(self):
+        """Read the notification rules of the profile"""
+        get_list = lambda key: (self.profile.get(key) or '').splitlines()
+        min_priority = self.profile.get('min_priority')
+        self.message_filter = MessageFilter(get_list('senders'), 
+                                            get_list('excluded_senders'), 
+                                            get_list('subjects'), 
+                                            get_list('excluded_subjects'), 
+                                            int(min_priority) if min_priority 
+                                            else None)
+        fields = self.message_filter.header_fields
+        self.parse_header = HeaderFieldParser(('From', 'Subject') + fields)
+        self.fetch_items = ('(BODY.PEEK[HEADER.FIELDS '
+                            '(FROM SUBJECT DATE MESSAGE-ID{})])'.format(
+                            ''.join(' ' + field.upper() for field in fields)))
+    
+    def _check_cycle(self, verbose, mailboxes=None):
+        """Check for new messages every mailbox, or the given ones
+        
+        Return False if the check was cancelled.
+        """
+        self._activity = 'checking'
+        try:
+            start = time.monotonic()
+            self._connect(verbose)
+            if self._cancel.is_set():
+                return False
+            if mailboxes is None:
+                mailboxes = self._get_due_mailboxes(self._list_mailboxes())
+            status = self._get_status(mailboxes)
+            for mailbox in mailboxes:
+                notified = self._notified
+                mailbox_start = time.monotonic()
+                if not self._check_mailbox(mailbox, verbose, 
+                                           status.get(mailbox.strip(b'"'))):
+                    return False
+                self._last_checks[mailbox] = (time.time(), 
+                    time.monotonic() - mailbox_start, self._notified - notified)
+                self._reschedule(mailbox, self._notified - notified)
+            self._last_cycle = (time.time(), time.monotonic() - start, 
+                                len(mailboxes))
+            return True
+        finally:
+            self._activity = None
+    
+    def _get_due_mailboxes(self, mailboxes):
+        """Return the mailboxes due for checking
+        
+        Mailboxes due within half 'min_period' are included, so they're 
+        checked together instead of each one in its own check. Mailboxes 
+        not due yet are included too if their STATUS from a LIST-STATUS 
+        command shows new unread messages.
+        """
+        try:
+            limit = time.monotonic() + self.profile.getfloat('min_period') / 2
+        except ValueError: # single check
+            return mailboxes
+        due = []
+        for mailbox in mailboxes:
+            schedule = self._schedule.get(mailbox)
+            status = self._listed_status.get(mailbox.strip(b'"'))
+            if schedule is None or schedule[0] <= limit or (status is not None 
+                    and not self._is_unchanged(mailbox, status)):
+                due.append(mailbox)
+        return due
+    
+    def _reschedule(self, mailbox, new_messages):
+        """Schedule the next check of a mailbox after checking it
+        
+        The rate of new messages of every mailbox is estimated with an 
+        exponential moving average, and the mailbox is checked again when 
+        a new message is expected, between 'min_period' and 'max_period' 
+        seconds. A random 'period_jitter' fraction of the interval is 
+        added or removed, so that clients don't synchronize.
+        """
+        try:
+            period = self.profile.getfloat('period')
+        except ValueError: # single check
+            return
+        now = time.monotonic()
+        due, rate, last_check = self._schedule.get(mailbox, 
+                                                   (now, 1 / period, None))
+        if last_check is not None and now > last_check:
+            rate += (new_messages / (now - last_check) - rate) * 0.3
+        interval = min(max(1 / rate if rate else float('inf'), 
+                           self.profile.getfloat('min_period')), 
+                       self.profile.getfloat('max_period'))
+        jitter = self.profile.getfloat('period_jitter')
+        interval *= random.uniform(1 - jitter, 1 + jitter)
+        self._schedule[mailbox] = now + interval, rate, now
+    
+    def _get_next_check_delay(self):
+        """Return the seconds until a mailbox is due for checking"""
+        if not self._schedule:
+            return self.profile.getfloat('period')
+        return max(min(due for due, rate, last_check in 
+                       self._schedule.values()) - time.monotonic(), 0)
+    
+    def _logout(self, verbose):
+        if self.session is None:
+            return
+        message = self.session.logout()
+        if verbose and message:
+            print('\n' + message)
+    
+    def _list_mailboxes(self):
+        """Return the names of the mailboxes to check, as sent by the server
+        
+        The list is reused for 'list_refresh' seconds, or until a mailbox 
+        is found missing. With LIST-STATUS the list is requested every 
+        time, as it comes with the mailboxes status, but only new LIST 
+        responses are parsed and filtered.
+        
+        On Gmail, only the All Mail mailbox is returned, see _list_gmail.
+        """
+        list_status = 'LIST-STATUS' in self.mail.capabilities
+        if not list_status and self._mailboxes is not None and \
+           time.monotonic() < self._list_expiry:
+            return self._mailboxes
+        with self.metrics.time('list', self._get_account(), 
+                               connection=self.mail):
+            if list_status:
+                ok, mblist, status_list = self.mail.list_status(
+                                                    self._get_status_items())
+                self._listed_status = self._parse_status_responses(
+                                                        status_list)
+            else:
+                ok, mblist = self.mail.list()
+        mailboxes = []
+        list_lines = {}
+        for line in mblist:
+            if line in self._list_lines:
+                mailbox = self._list_lines[line]
+            else:
+                mailbox = self._filter_list_response(line)
+            list_lines[line] = mailbox
+            if mailbox is not None:
+                mailboxes.append(mailbox)
+        self._list_lines = list_lines
+        self._all_mail = self._list_gmail(list_lines)
+        if self._all_mail is not None:
+            mailboxes = [self._all_mail]
+        self._mailboxes = mailboxes
+        # forget the schedule of deleted or excluded mailboxes
+        for mailbox in set(self._schedule).difference(mailboxes):
+            del self._schedule[mailbox]
+        self._list_expiry = time.monotonic() + \
+                            self.profile.getfloat('list_refresh')
+        return mailboxes
+    
+    def _filter_list_response(self, line):
+        """Return the mailbox name of a LIST response, or None if excluded"""
+        flags, delimiter, mailbox = self._parse_list_response(line)
+        if self.config.mailbox_filter.excludes(
+                            decode_imap_utf7(mailbox.strip(b'"')), flags):
+            return None
+        return mailbox
+    
+    def _list_gmail(self, list_lines):
+        """Return the All Mail mailbox if it's to be checked instead of 
+        every mailbox, or None
+        
+        Gmail mailboxes are views of labels, so a message is in as many of 
+        them as labels it has, and All Mail has every message but spam and 
+        trash (X-GM-EXT-1). A single search of All Mail replaces the checks 
+        of every mailbox, notifying a message from the first mailbox to 
+        check among the ones of its labels, saved by label in 
+        _gmail_labels.
+        """
+        if 'X-GM-EXT-1' not in self.mail.capabilities or \
+           not self.profile.getboolean('gmail_all_mail', True):
+            return None
+        all_mail = None
+        labels = {}
+        for line, mailbox in list_lines.items():
+            flags, delimiter, name = self._parse_list_response(line)
+            flags = [flag.lower() for flag in flags]
+            if r'\all' in flags:
+                all_mail = name
+            if mailbox is None:
+                continue
+            name = decode_imap_utf7(name.strip(b'"'))
+            if r'\all' in flags: # not excluded, so the fallback
+                label = None
+            elif name.upper() == 'INBOX':
+                label = r'\inbox'
+            else:
+                label = next((self.gmail_flag_labels[flag] for flag in flags 
+                              if flag in self.gmail_flag_labels), name).lower()
+            labels.setdefault(label, name)
+        self._gmail_labels = labels
+        return all_mail
+    
+    def _get_label_mailbox(self, data, threads):
+        """Return the mailbox to notify a message of All Mail from, or None 
+        if excluded
+        
+        'data' is the FETCH response, with the X-GM-LABELS and X-GM-THRID 
+        of the message. Only the first message of a thread is notified, 
+        'threads' being the ones already notified.
+        """
+        match = self.re_fetch_thread.search(data)
+        thread = match and match.group(1)
+        if thread is not None and thread in threads:
+            return None
+        match = self.re_fetch_labels.search(data)
+        message_labels = set()
+        for quoted, atom in self.re_label.findall(match.group(1) if match 
+                                                  else b''):
+            label = re.sub(br'\\(.)', br'\1', quoted) if quoted else atom
+            message_labels.add(decode_imap_utf7(label).lower())
+        name = next((name for label, name in self._gmail_labels.items() 
+                     if label in message_labels), 
+                    self._gmail_labels.get(None))
+        if name is not None and thread is not None:
+            threads.add(thread)
+        return name
+    
+    def _refresh_mailboxes(self):
+        """List the mailboxes again in the next check"""
+        self._list_expiry = 0
+    
+    def _get_status(self, mailboxes):
+        """Return the STATUS of the mailboxes, by unquoted mailbox name
+        
+        The status from a LIST-STATUS command is used if available, else 
+        the STATUS commands are pipelined.
+        """
+        status, self._listed_status = self._listed_status, {}
+        mailboxes = [mailbox for mailbox in mailboxes 
+                     if mailbox.strip(b'"') not in status]
+        status_items = self._get_status_items()
+        results = self.mail.pipeline(('STATUS', (mailbox, status_items), 
+                                      'STATUS') for mailbox in mailboxes)
+        for mailbox in mailboxes:
+            with self.metrics.time('status', self._get_account(), 
+                                   decode_imap_utf7(mailbox.strip(b'"')), 
+                                   self.mail) as timer:
+                ok, data = next(results)
+                timer.error = ok != 'OK'
+            if ok == 'OK':
+                status.update(self._parse_status_responses(data))
+            else:
+                self._refresh_mailboxes()
+        return status
+    
+    def _get_status_items(self):
+        """Return the STATUS items to request, HIGHESTMODSEQ too with 
+        CONDSTORE"""
+        if 'CONDSTORE' in self.mail.capabilities:
+            return self.status_items[:-1] + ' HIGHESTMODSEQ)'
+        return self.status_items
+    
+    def _parse_status_responses(self, data):
+        status = {}
+        for line in data:
+            match = isinstance(line, bytes) and \
+                    self.re_status_response.match(line)
+            if match:
+                items = match.group(2).decode().split()
+                status[match.group(1).strip(b'"')] = dict(
+                                    zip(items[::2], map(int, items[1::2])))
+        return status
+    
+    def _check_mailbox(self, mailbox, verbose, status=None):
+        """Notify about new unread messages in a mailbox
+        
+        If the mailbox STATUS is given, the mailbox is only selected when 
+        there can be new unread messages.
+        
+        Return False if the check was cancelled.
+        """
+        if self._cancel.is_set():
+            return False
+        if mailbox == self._all_mail and mailbox not in self.uid_dict and \
+           self.uid_dict:
+            self._start_all_mail(mailbox, verbose, status)
+            return True
+        if status is not None and self._is_unchanged(mailbox, status):
+            if verbose:
+                print(decode_imap_utf7(mailbox.strip(b'"')), 
+                      self.uid_dict[mailbox][1], [])
+            return True
+        account = self._get_account()
+        mailbox_name = decode_imap_utf7(mailbox.strip(b'"'))
+        gmail = mailbox == self._all_mail
+        
+        # search for new unread messages
+        # UIDNEXT is the starting UID for the next check, only valid while 
+        # UIDVALIDITY doesn't change. With CONDSTORE, only the messages 
+        # changed since HIGHESTMODSEQ are searched. The searches are sent 
+        # along with EXAMINE, and their results ignored if the state they 
+        # were made from turns out to be no longer valid. The notification 
+        # rules that IMAP can express are searched for too
+        uidvalidity, uidnext, modseq = self.uid_dict.get(mailbox, 
+                                                         (None, 0, None))
+        condstore = 'CONDSTORE' in self.mail.capabilities
+        first_uid = None
+        if condstore and modseq is not None:
+            first_uid = self._get_first_notified(mailbox)
+        rules = self.message_filter.search_criteria
+        rules = ' ' + rules if rules else ''
+        if condstore and modseq is not None:
+            search_criteria = '(UNSEEN UID {}:* MODSEQ {}{})'.format(uidnext, 
+                                                            modseq + 1, rules)
+        elif uidnext:
+            search_criteria = '(UNSEEN UID {}:*{})'.format(uidnext, rules)
+        else:
+            search_criteria = '(UNSEEN{})'.format(rules)
+        commands = [('EXAMINE', (mailbox, '(CONDSTORE)') if condstore else 
+                                (mailbox,), None), 
+                    ('UID', ('SEARCH', search_criteria), 'SEARCH')]
+        if condstore and modseq is not None and first_uid is not None:
+            commands.append(('UID', ('SEARCH', '(SEEN UID {}:* MODSEQ {})'
+                                     .format(first_uid, modseq + 1)), 
+                             'SEARCH'))
+        results = self.mail.pipeline(commands)
+        with self.metrics.time('select', account, mailbox_name, 
+                               self.mail) as timer:
+            ok, data = next(results)
+            timer.error = ok != 'OK'
+        if ok != 'OK': # deleted or renamed
+            results.close()
+            self._refresh_mailboxes()
+            return True
+        
+        ok, new_uidvalidity = self.mail.response('UIDVALIDITY')
+        new_uidvalidity = int(new_uidvalidity[0])
+        ok, new_uidnext = self.mail.response('UIDNEXT')
+        new_uidnext = int(new_uidnext[0])
+        ok, new_modseq = self.mail.response('HIGHESTMODSEQ')
+        new_modseq = int(new_modseq[0]) if new_modseq[0] else None
+        if uidvalidity is not None and uidvalidity != new_uidvalidity:
+            # the stored UIDs are meaningless now, so don't notify about 
+            # every unread message again, just start over from here
+            if verbose:
+                print(mailbox_name, 'UIDVALIDITY changed')
+            results.close()
+            self.state.forget_notified_uids(self.profile.name, 
+                                            self._get_notified_names(mailbox))
+            self._save_state(mailbox, new_uidvalidity, new_uidnext, 
+                             new_modseq)
+            self.mail.close()
+            return True
+        if condstore and modseq is not None and new_modseq == modseq:
+            # nothing changed
+            results.close()
+            if verbose:
+                print(mailbox_name, uidnext, [])
+            self.mail.close()
+            return True
+        with self.metrics.time('search', account, mailbox_name, self.mail):
+            if 'MODSEQ' in search_criteria and new_modseq is None:
+                # no mod-sequences in the mailbox (NOMODSEQ)
+                results.close()
+                ok, data = self.mail.uid('SEARCH', None, 
+                                         '(UNSEEN UID {}:*{})'.format(uidnext, 
+                                                                      rules))
+            else:
+                ok, data = next(results)
+        for ok_read, data_read in results:
+            if ok_read == 'OK':
+                for name in self._get_notified_names(mailbox):
+                    self._discard_read(name, first_uid, data_read, verbose)
+        if self._cancel.is_set():
+            self.mail.close()
+            return False
+        # 'n:*' always includes the last message, because IMAP
+        uids = sorted(uid for uid in self._parse_search_response(data) 
+                      if uid >= uidnext)
+        if verbose:
+            print(mailbox_name, uidnext, uids)
+        if not uids:
+            self._save_state(mailbox, new_uidvalidity, new_uidnext, 
+                             new_modseq)
+            self.mail.close()
+            return True
+        
+        # parse headers for 'From' and 'Subject' and 
+        # notify Growl about the new messages
+        if verbose: print('')
+        batch_size = self.profile.getint('fetch_batch_size')
+        fetch_items = self.fetch_items
+        if gmail:
+            fetch_items = '(X-GM-THRID X-GM-LABELS ' + fetch_items[1:]
+        threads = set()
+        message = None
+        # the stored UIDNEXT is advanced past every message notified, as 
+        # long as those before were handled too, so that an error later in 
+        # the mailbox doesn't notify them again
+        handled = set()
+        next_index = 0
+        responses = self.mail.fetch_stream(
+                                    [uid_set(uids[i:i + batch_size]) 
+                                     for i in range(0, len(uids), batch_size)], 
+                                    fetch_items)
+        while True:
+            # every message is parsed and notified as soon as it's read
+            with self.metrics.time('fetch', account, mailbox_name, self.mail):
+                item = next(responses, None)
+            if item is None:
+                break
+            if self._cancel.is_set():
+                responses.close()
+                self.mail.close()
+                return False
+            if isinstance(item, tuple):
+                # notified when the rest of the response is read, which can 
+                # have more items, e.g. X-GM-LABELS after the header
+                message = item
+                continue
+            if message is None:
+                continue
+            data, raw_header = message[0] + item, message[1]
+            message = None
+            match = self.re_fetch_uid.search(data)
+            uid = match and int(match.group(1))
+            name = mailbox_name
+            if gmail:
+                name = self._get_label_mailbox(data, threads)
+            if name is None:
+                if verbose:
+                    print(mailbox_name, 'excluded by label/thread:', uid)
+                notified = False
+            else:
+                notified = self._notify_header(raw_header, name, verbose, uid)
+            handled.add(uid)
+            while next_index < len(uids) and uids[next_index] in handled:
+                next_index += 1
+            if notified and next_index:
+                self._save_state(mailbox, new_uidvalidity, 
+                                 uids[next_index - 1] + 1, modseq)
+        self._save_state(mailbox, new_uidvalidity, new_uidnext, new_modseq)
+        self.mail.close()
+        return True
+    
+    def _start_all_mail(self, mailbox, verbose, status=None):
+        """Start checking Gmail All Mail from its current UIDNEXT
+        
+        Done when the account was checked mailbox by mailbox before, so 
+        its unread messages aren't notified again.
+        """
+        if status is None:
+            status = self._get_status([mailbox]).get(mailbox.strip(b'"'), {})
+        if 'UIDVALIDITY' not in status or 'UIDNEXT' not in status:
+            return
+        if verbose:
+            print(decode_imap_utf7(mailbox.strip(b'"')), 'starting from', 
+                  status['UIDNEXT'])
+        self._save_state(mailbox, status['UIDVALIDITY'], status['UIDNEXT'], 
+                         status.get('HIGHESTMODSEQ'))
+    
+    def _get_notified_names(self, mailbox):
+        """Return the names the notifications of a mailbox are sent with, 
+        those of the label mailboxes for Gmail All Mail"""
+        if mailbox == self._all_mail:
+            return sorted(set(self._gmail_labels.values()))
+        return [decode_imap_utf7(mailbox.strip(b'"'))]
+    
+    def _get_first_notified(self, mailbox):
+        """Return the lowest UID of the pending notifications of a mailbox
+        
+        Only their messages can be read before being notified, so with 
+        nothing pending the read messages aren't searched for. The outbox 
+        is kept on disk, so this is known after restarting too.
+        """
+        return self.state.get_first_notified(self.profile.name, 
+                                             self._get_notified_names(mailbox))
+    
+    def _discard_read(self, mailbox_name, first_uid, data, verbose):
+        """Drop the pending notifications of the messages read since the 
+        last check, e.g. from another client
+        
+        'data' is the response to a search of the messages seen since, 
+        from 'first_uid', the lowest one of its pending notifications.
+        """
+        uids = [uid for uid in self._parse_search_response(data) 
+                if uid >= first_uid]
+        if uids:
+            if verbose:
+                print(mailbox_name, 'read since notified:', uids)
+            self.dispatcher.discard(self.profile.name, mailbox_name, uids)
+    
+    def _parse_search_response(self, data):
+        """Return the UIDs of a SEARCH response
+        
+        A search by MODSEQ adds the highest mod-sequence of the messages 
+        found in parentheses, which is ignored.
+        """
+        return [int(uid) for uid in data[0].partition(b'(')[0].split()]
+    
+    def _notify_header(self, raw_header, mailbox_name, verbose, uid=None):
+        """Notify a message, return True if it was queued
+        
+        A header that can't be decoded, e.g. with an unknown charset, is 
+        skipped, as it would fail again on every check.
+        """
+        account = self._get_account()
+        with self.metrics.time('parse', account, mailbox_name):
+            try:
+                header = self.parse_header(raw_header)
+                from_ = decode_header(header['From'])
+                subject = decode_header(header['Subject'])
+            except Exception as err:
+                print('{}: {} UID {} skipped, unable to parse the header: {}'
+                      .format(self.profile.name, mailbox_name, uid, err))
+                return False
+        if not self.message_filter.matches(from_, subject, 
+                                           header.get('X-Priority')):
+            if verbose:
+                print('Filtered out\nFrom: {}\nSubject: {}\n'.format(from_, 
+                                                                     subject))
+            return False
+        self._notified += 1
+        if verbose:
+            print('From: {}\nSubject: {}\n'.format(from_, subject))
+        with self.metrics.time('notify', account, mailbox_name):
+            self.dispatcher.put(self.profile.name, mailbox_name, from_, 
+                                subject, uid)
+        return True
+    
+    def _is_unchanged(self, mailbox, status):
+        """Return True if the STATUS shows no new unread messages
+        
+        With CONDSTORE, a mailbox with pending notifications is changed too 
+        when its HIGHESTMODSEQ is, as their messages could have been read 
+        since.
+        """
+        uidvalidity, uidnext, modseq = self.uid_dict.get(mailbox, 
+                                                         (None, 0, None))
+        new_uidvalidity = status.get('UIDVALIDITY')
+        new_uidnext = status.get('UIDNEXT')
+        new_modseq = status.get('HIGHESTMODSEQ')
+        if new_uidvalidity is None or new_uidnext is None or \
+           uidvalidity not in (None, new_uidvalidity):
+            return False
+        if modseq is not None and new_modseq not in (None, modseq) and \
+           self._get_first_notified(mailbox) is not None:
+            return False
+        if new_uidnext == uidnext:
+            return True
+        if status.get('UNSEEN') == 0:
+            self._save_state(mailbox, new_uidvalidity, new_uidnext, 
+                             new_modseq)
+            return True
+        return False
+    
+    def _save_state(self, mailbox, uidvalidity, uidnext, highestmodseq=None):
+        if self.uid_dict.get(mailbox) != (uidvalidity, uidnext, 
+                                          highestmodseq):
+            self.uid_dict[mailbox] = uidvalidity, uidnext, highestmodseq
+            self.state.save(self._get_account(), mailbox, uidvalidity, uidnext, 
+                            highestmodseq)
+    
+    def _get_idle_mailbox(self):
+        """Return the mailbox to watch with IDLE, or None if not available"""
+        if 'IDLE' not in self.mail.capabilities:
+            return None
+        name = self.profile.get('idle_mailbox')
+        if not name:
+            return None
+        if self._all_mail is not None:
+            return self._all_mail
+        for mailbox in self._mailboxes:
+            if decode_imap_utf7(mailbox.strip(b'"')) == name:
+                return mailbox
+    
+    def _idle(self, mailbox, period, verbose):
+        """Check a mailbox as soon as new messages arrive, for 'period' seconds
+        
+        IDLE is re-issued before the server timeout (29 minutes at least, 
+        RFC 2177), following the 'idle_timeout' setting.
+        """
+        idle_timeout = self.profile.getint('idle_timeout')
+        end = time.monotonic() + period
+        while not self._cancel.is_set():
+            timeout = min(end - time.monotonic(), idle_timeout)
+            if timeout <= 0:
+                break
+            if verbose:
+                print('\nidling...', decode_imap_utf7(mailbox.strip(b'"')))
+            self._activity = 'idling'
+            try:
+                self.mail.select(mailbox, readonly=True)
+                new = self.mail.idle(timeout, self._cancel)
+                self.mail.close()
+                if new:
+                    self._check_mailbox(mailbox, verbose)
+            finally:
+                self._activity = None
+    
     def _parse_list_response(self, line):
         flags, delimiter, mailbox_name = \
                                     self.re_list_response.match(line).groups()
         return flags.decode().split(), delimiter, mailbox_name
     
-    def _decode_header(self, raw_header):
-        header = ''
-        for header_part, header_part_charset in \
-                                        email.header.decode_header(raw_header):
-            if header_part_charset is not None:
-                header += header_part.decode(header_part_charset)
-            elif isinstance(header_part, bytes):
-                header += header_part.decode()
-            else:
-                header += header_part
-        return header
-    
     def _power_thread_f(self):
         """Pause checking for new e-mails when the system enters suspended state
         
@@ -352,82 +2453,816 @@ def _power_thread_f(self):
             pythoncom.CoUninitialize()
     
     def wait(self):
+        """Handle the pause, resume, check-now, reload-config and exit 
+        requests, until exiting"""
         verbose = self.config['general'].getboolean('verbose')
-        self._queue = queue.Queue()
+        # waiting without a timeout can't be interrupted with Ctrl+C on 
+        # Windows
+        timeout = 2 if os.name == 'nt' else None
         while True:
             try:
-                item = self._queue.get(timeout=2)
+                item = self._queue.get(timeout=timeout)
             except queue.Empty:
                 continue
             if item in (self.pause, self.pause_internal):
                 if verbose:
                     print('\npausing...')
+                self._paused = True
                 self.cancel(cancel_all=item == self.pause)
             elif item in (self.resume, self.resume_internal):
                 try:
                     period = self.profile.getboolean('period')
                 except ValueError:
                     period = True
-                if not period:
+                if not period or not self._paused:
                     continue
                 if verbose:
                     print('\nresuming...')
+                self._paused = False
                 self.check(power=item == self.resume)
+            elif item == self.check_now:
+                if self._paused:
+                    continue
+                if verbose:
+                    print('\nchecking now...')
+                self.cancel(cancel_all=False, logout=False)
+                self._make_due()
+                self.check()
+            elif item == self.reload:
+                if verbose:
+                    print('\nreloading settings...')
+                self.cancel(cancel_all=False, logout=False)
+                self.reload_config()
+                verbose = self.config['general'].getboolean('verbose')
+                if not self._paused:
+                    self.check()
             elif item == self.exit:
                 if verbose:
                     print('\nexiting...')
                 self.cancel()
+                self._close_control()
+                self._close_dispatcher()
+                self.metrics.close()
                 break
             elif item == self.error:
                 self.cancel()
+                self._close_control()
+                self._close_dispatcher()
+                self.metrics.close()
                 raise SystemExit(self._queue.get())
     
-    def cancel(self, cancel_all=True):
+    def _make_due(self):
+        """Make every mailbox due for checking, listing them again"""
+        for mailbox, (due, rate, last_check) in list(self._schedule.items()):
+            self._schedule[mailbox] = 0, rate, last_check
+        self._refresh_mailboxes()
+    
+    def cancel(self, cancel_all=True, logout=True):
+        """Stop checking, interrupting the IMAP command in progress"""
         self._cancel.set()
         if hasattr(self._check_thread, 'cancel'):
             self._check_thread.cancel()
+        self._interrupt()
         if cancel_all:
             self._cancel_all.set()
             if self._power_thread:
                 self._power_thread.join(5)
                 self._power_thread = None
         self._check_thread.join(10)
+        if logout and not self._check_thread.is_alive():
+            self._logout(self.config['general'].getboolean('verbose'))
+    
+    def _interrupt(self):
+        """Interrupt the connection if it's in use"""
+        if self._activity is not None and self.session is not None:
+            self.session.interrupt()
+
+
+class MultiChecker(EmailChecker):
+    """Check every profile of the settings file concurrently
+    
+    Every profile is watched by a task of a single asyncio event loop, and 
+    all of them share the same GNTP notifier. IMAP commands are blocking, 
+    so the checks run in a pool of 'max_connections' threads (general 
+    section), and accounts don't use any thread between checks. Every 
+    account can check its mailboxes with up to 'account_connections' 
+    connections at the same time.
+    
+    When the connections of every account fit in 'max_connections', they're 
+    kept open between checks, and accounts whose server supports it wait 
+    for new messages in 'idle_mailbox' with IDLE, as a single profile 
+    does, each one using a thread meanwhile. Otherwise, accounts are only 
+    polled, every 'min_period' seconds at most.
+    """
+    
+    def __init__(self, config_path=None, config=None, profiles=None):
+        super().__init__(config_path, config)
+        self._open_state()
+        self.profiles = profiles
+        self._create_accounts()
+        self._loop = None
+        self._tasks = []
+    
+    def _create_accounts(self):
+        self.accounts = {}
+        for name in self._get_profiles():
+            # every connection of an account is handled by its own checker
+            checkers = []
+            for i in range(self.config[name].getint('account_connections')):
+                checker = EmailChecker(config=self.config, profile=name)
+                checker._cancel = self._cancel
+                checker.state = self.state
+                checker.dispatcher = self.dispatcher
+                checker.metrics = self.metrics
+                if checkers:
+                    checker.uid_dict = checkers[0].uid_dict
+                    checker._schedule = checkers[0]._schedule
+                    checker._last_checks = checkers[0]._last_checks
+                    # the mailboxes are listed by the first checker only
+                    checker._refresh_mailboxes = checkers[0]._refresh_mailboxes
+                else:
+                    checker._open_state()
+                checkers.append(checker)
+            self.accounts[name] = checkers
+    
+    def reload_config(self):
+        """Read the settings files again, keeping the command line settings
+        
+        Accounts are created again for the current profiles. Profiles added 
+        since starting are notified as the first one.
+        """
+        if not super().reload_config():
+            return False
+        self._create_accounts()
+        return True
+    
+    def get_status(self):
+        profiles = OrderedDict()
+        for name, checkers in list(self.accounts.items()):
+            status = checkers[0].get_status()
+            status['connected'] = sum(checker.session is not None and 
+                                      checker.session.mail is not None 
+                                      for checker in checkers)
+            status['notified'] = sum(checker._notified for checker in checkers)
+            del status['profile']
+            profiles[name] = status
+        return OrderedDict([('state', self._get_state_name()), 
+                            ('profiles', profiles)])
+    
+    def _get_profiles(self):
+        """Return the names of the profiles with an user, in order
+        
+        Only the 'profiles' given on creation are included, if any.
+        """
+        return [section for section in self.config.sections() 
+                if 'hostname' in self.config[section] and 
+                   self.config[section].get('user_id') and 
+                   (self.profiles is None or section in self.profiles)]
+    
+    def register_gntp(self):
+        names = list(self.accounts)
+        self.growl_notifier = gntp.notifier.GrowlNotifier(
+            applicationName=name,
+            notifications=names,
+            defaultNotifications=names,
+            applicationIcon=self._get_icon(),
+            **self._get_growl_address())
+        self._icons = {name: self._get_icon(self.config[name]) 
+                       for name in names}
+        self._start_dispatcher()
+        for checkers in self.accounts.values():
+            for checker in checkers:
+                checker.dispatcher = self.dispatcher
+    
+    def start_metrics(self):
+        super().start_metrics()
+        for checkers in self.accounts.values():
+            for checker in checkers:
+                checker.metrics = self.metrics
+    
+    def notify(self, title, description, profile_name=None):
+        if profile_name not in self._icons: # removed profile, or no profile
+            profile_name = next(iter(self._icons))
+        # the profile can be removed when reloading the settings
+        profile = self.config[profile_name if 
+                              self.config.has_section(profile_name) else 
+                              self.config.default_section]
+        return self.growl_notifier.notify(profile_name, title, description, 
+                                          icon=self._icons[profile_name], 
+                                          sticky=profile['sticky'], 
+                                          priority=1, 
+                                          callback=profile['url'])
+    
+    def _do_check(self):
+        self._loop = asyncio.new_event_loop()
+        max_connections = self.config['general'].getint('max_connections')
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_connections)
+        self._activity = 'checking'
+        try:
+            errors = self._loop.run_until_complete(
+                                            self._watch_all(max_connections))
+        finally:
+            self._activity = None
+            self._executor.shutdown(wait=True)
+            self._loop.close()
+        if self._cancel.is_set():
+            return
+        errors = [err_str for err_str in errors if err_str]
+        if errors:
+            self._queue.put(self.error)
+            self._queue.put('\n'.join(errors))
+        else:
+            self._queue.put(self.exit)
+    
+    async def _watch_all(self, max_connections):
+        self._connections = asyncio.Semaphore(max_connections)
+        # keep the connections open between checks only if they fit the limit
+        keep_open = sum(len(checkers) for checkers in 
+                        self.accounts.values()) <= max_connections
+        self._tasks = [asyncio.ensure_future(self._watch(name, keep_open)) 
+                       for name in self.accounts]
+        results = await asyncio.gather(*self._tasks, return_exceptions=True)
+        return [result for result in results if isinstance(result, str)]
+    
+    async def _watch(self, name, keep_open):
+        """Check an account periodically, return an error string on failure
+        
+        Errors are retried with an exponential backoff, not only connection 
+        errors, as the other accounts keep being checked. Those are shown 
+        when they happen, even if not verbose, and in the status.
+        """
+        checkers = self.accounts[name]
+        profile = checkers[0].profile
+        verbose = self.config['general'].getboolean('verbose')
+        failures = 0
+        while not self._cancel.is_set():
+            if verbose:
+                print('\n\nchecking {}...'.format(name), 
+                      datetime.now(timezone.utc).astimezone())
+            try:
+                period = profile.getboolean('period')
+            except ValueError:
+                period = True
+            fatal_error = None
+            idle_mailbox = None
+            try:
+                await self._check_account(checkers, verbose)
+                failures = 0
+                checkers[0]._last_error = None
+                if period and keep_open and not self._cancel.is_set():
+                    # wait for new messages in the IDLE mailbox until the 
+                    # next check of a mailbox is due
+                    idle_mailbox = checkers[0]._get_idle_mailbox()
+                    if idle_mailbox is not None:
+                        await self._run(checkers[0]._idle, idle_mailbox, 
+                                        checkers[0]._get_next_check_delay(), 
+                                        verbose)
+            except Exception as err:
+                err_str = '{}: {}'.format(name, self._format_error(err))
+                for checker in checkers:
+                    if checker.session is not None:
+                        checker.session.close()
+                failures += 1
+                # not a connection error, e.g. a failed login
+                if not isinstance(err, (OSError, imaplib.IMAP4.abort)):
+                    fatal_error = err_str
+                last_error = checkers[0]._last_error
+                if verbose or fatal_error and (last_error is None or 
+                                               last_error[1] != err_str):
+                    print(err_str)
+                checkers[0]._last_error = time.time(), err_str
+            if not keep_open:
+                for checker in checkers:
+                    checker._logout(verbose)
+            if not period:
+                if fatal_error:
+                    return fatal_error
+                break
+            if failures:
+                await asyncio.sleep(checkers[0]._get_retry_delay(failures))
+            elif idle_mailbox is None:
+                await asyncio.sleep(checkers[0]._get_next_check_delay())
+        for checker in checkers:
+            checker._logout(verbose)
+    
+    async def _check_account(self, checkers, verbose):
+        if len(checkers) == 1:
+            await self._run(checkers[0]._check_cycle, verbose)
+            return
+        # list the mailboxes due and split them between the connections, 
+        # along with their status if listed too (LIST-STATUS)
+        def list_mailboxes():
+            checkers[0]._connect(verbose)
+            mailboxes = checkers[0]._get_due_mailboxes(
+                                            checkers[0]._list_mailboxes())
+            status, checkers[0]._listed_status = checkers[0]._listed_status, {}
+            return mailboxes, status
+        mailboxes, status = await self._run(list_mailboxes)
+        for i, checker in enumerate(checkers):
+            checker._listed_status = {
+                mailbox.strip(b'"'): status[mailbox.strip(b'"')] 
+                for mailbox in mailboxes[i::len(checkers)] 
+                if mailbox.strip(b'"') in status}
+        results = await asyncio.gather(*[
+            self._run(checker._check_cycle, verbose, 
+                      mailboxes[i::len(checkers)]) 
+            for i, checker in enumerate(checkers) 
+            if mailboxes[i::len(checkers)]], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+    
+    async def _run(self, function, *args):
+        """Run a blocking function in the thread pool"""
+        async with self._connections:
+            return await self._loop.run_in_executor(self._executor, 
+                                                    function, *args)
+    
+    def _cancel_tasks(self):
+        for task in self._tasks:
+            task.cancel()
+    
+    def _logout(self, verbose):
+        for checkers in self.accounts.values():
+            for checker in checkers:
+                checker._logout(verbose)
+    
+    def _interrupt(self):
+        for checkers in self.accounts.values():
+            for checker in checkers:
+                checker._interrupt()
+    
+    def _make_due(self):
+        for checkers in self.accounts.values():
+            checkers[0]._make_due()
+    
+    def cancel(self, cancel_all=True, logout=True):
+        self._cancel.set()
+        if self._loop is not None and not self._loop.is_closed():
+            try:
+                self._loop.call_soon_threadsafe(self._cancel_tasks)
+            except RuntimeError: # loop closed meanwhile
+                pass
+        super().cancel(cancel_all, logout)
+
+
+class Supervisor(MultiChecker):
+    """Check every profile of the settings file with worker processes
+    
+    The profiles are split between 'workers' processes, every one checking 
+    its profiles like a MultiChecker, with up to 'max_connections' 
+    connections. Workers pass their notifications and metrics on to the 
+    supervisor, which sends and serves them like a MultiChecker does.
+    
+    A dead worker is replaced by a new process checking the same profiles, 
+    with an exponential backoff between restarts like for reconnections. 
+    After 'rebalance_failures' failures in a row, its other profiles are 
+    moved to the live workers, keeping only the one named in its error, or 
+    else the last one moved to it. Workers whose memory usage exceeds 
+    'worker_max_memory' MiB are restarted too (only on Linux).
+    
+    The errors of the workers are passed on to the supervisor. With a 
+    single check ('period' disabled) a failed worker isn't restarted, and 
+    the supervisor exits with the errors of every one.
+    """
+    
+    report_interval = 5
+    rebalance_failures = 3
+    
+    def __init__(self, config_path=None, config=None):
+        EmailChecker.__init__(self, config_path, config)
+        self.profiles = None
+        self._create_accounts()
+        self._context = multiprocessing.get_context('spawn')
+        self._shards = []
+        self._workers = []
+        self._last_errors = []
+        # errors of the workers, by process id
+        self._worker_errors = {}
+        self._worker_error_received = threading.Condition()
+        self._loop = None
+        self._tasks = []
+    
+    def _create_accounts(self):
+        # the profiles are checked by the workers
+        self.accounts = {name: [] for name in self._get_profiles()}
+    
+    def _make_due(self):
+        # workers started again check every mailbox
+        pass
+    
+    def get_status(self):
+        """Return the state of the checker and the profiles of every worker
+        
+        The mailboxes are checked by the workers, so their state isn't 
+        known.
+        """
+        workers = []
+        for shard, worker, last_error in zip(self._shards, 
+                                             list(self._workers), 
+                                             list(self._last_errors)):
+            workers.append(OrderedDict([
+                ('profiles', list(shard)), 
+                ('pid', worker.pid if worker is not None else None), 
+                ('alive', worker is not None and worker.is_alive()), 
+                ('last_error', last_error and OrderedDict([
+                    ('time', format_time(last_error[0])), 
+                    ('error', last_error[1])]))]))
+        return OrderedDict([('state', self._get_state_name()), 
+                            ('workers', workers)])
+    
+    def _get_shards(self):
+        """Split the profiles between the workers, by number of connections"""
+        workers = min(self.config['general'].getint('workers'), 
+                      len(self.accounts))
+        shards = [[] for i in range(workers)]
+        loads = [0] * workers
+        for name in self.accounts:
+            i = loads.index(min(loads))
+            shards[i].append(name)
+            loads[i] += self.config[name].getint('account_connections')
+        return shards
+    
+    def _do_check(self):
+        verbose = self.config['general'].getboolean('verbose')
+        config_file = io.StringIO()
+        self.config.write(config_file)
+        results = self._context.Queue()
+        receiver = threading.Thread(target=self._receive, args=(results,), 
+                                    daemon=True)
+        receiver.start()
+        shards = self._get_shards()
+        # worker processes, and pipes for asking them to exit
+        workers = [None] * len(shards)
+        controls = [None] * len(shards)
+        self._shards, self._workers = shards, workers
+        self._last_errors = [None] * len(shards)
+        self._worker_errors.clear()
+        self._activity = 'checking'
+        errors = []
+        try:
+            errors = self._supervise(shards, workers, controls, 
+                                     config_file.getvalue(), results, verbose)
+        except Exception as err:
+            errors = [self._format_error(err)]
+        finally:
+            for control in controls:
+                if control is not None:
+                    try:
+                        control.send(None)
+                    except OSError:
+                        pass
+            end = time.monotonic() + 10
+            for worker, control in zip(workers, controls):
+                if worker is not None:
+                    worker.join(max(end - time.monotonic(), 0))
+                    if worker.is_alive():
+                        worker.terminate()
+                    control.close()
+            results.put(None)
+            receiver.join()
+            self._activity = None
+        if self._cancel.is_set():
+            return
+        if errors:
+            self._queue.put(self.error)
+            self._queue.put('\n'.join(errors))
+        else:
+            self._queue.put(self.exit)
+    
+    def _supervise(self, shards, workers, controls, config_string, results, 
+                   verbose):
+        """Run the workers until cancelled, or until every one is done
+        
+        Return the errors of the workers that failed a single check.
+        """
+        max_memory = self.config['general'].getfloat('worker_max_memory')
+        collect_metrics = isinstance(self.metrics, Metrics)
+        failures = [0] * len(shards)
+        started = [0] * len(shards)
+        restart = [0] * len(shards)
+        # workers asked to exit, to start again with more profiles
+        rebalanced = set()
+        done = set()
+        errors = []
+        while not self._cancel.is_set() and len(done) < len(shards):
+            now = time.monotonic()
+            for i, worker in enumerate(workers):
+                if i in done:
+                    continue
+                if worker is None:
+                    if now >= restart[i]:
+                        control, controls[i] = self._context.Pipe(False)
+                        workers[i] = self._context.Process(target=run_worker, 
+                            args=(config_string, shards[i], results, control, 
+                                  collect_metrics), 
+                            daemon=True)
+                        workers[i].start()
+                        control.close()
+                        started[i] = now
+                    continue
+                if worker.is_alive():
+                    memory = max_memory and get_memory_usage(worker.pid)
+                    if memory and memory > max_memory * 2 ** 20:
+                        if verbose:
+                            print('\nworker {} using {:.0f} MiB, '
+                                  'restarting'.format(i, memory / 2 ** 20))
+                        worker.terminate()
+                        worker.join()
+                        workers[i] = None
+                        controls[i].close()
+                        controls[i] = None
+                    continue
+                workers[i] = None
+                controls[i].close()
+                controls[i] = None
+                if i in rebalanced:
+                    rebalanced.discard(i)
+                    restart[i] = now
+                    continue
+                if worker.exitcode == 0: # single check
+                    done.add(i)
+                    continue
+                error = self._get_worker_error(worker)
+                last_error = self._last_errors[i]
+                self._last_errors[i] = time.time(), error
+                if self._is_single_check(shards[i]):
+                    done.add(i)
+                    errors.append(error)
+                    continue
+                if now - started[i] > self.profile.getfloat('max_retry_delay'):
+                    failures[i] = 0
+                failures[i] += 1
+                delay = self._get_retry_delay(failures[i])
+                restart[i] = now + delay
+                if verbose or last_error is None or last_error[1] != error:
+                    print('\nworker {} failed, restarting in {:.0f} s\n{}'
+                          .format(i, delay, error))
+                if failures[i] == self.rebalance_failures:
+                    self._rebalance(i, error, shards, workers, controls, 
+                                    failures, done, rebalanced, verbose)
+            self._cancel.wait(1)
+        return errors
+    
+    def _get_worker_error(self, worker):
+        """Return the error a dead worker passed on before exiting
+        
+        It can be received a bit after the worker is found dead.
+        """
+        with self._worker_error_received:
+            self._worker_error_received.wait_for(
+                            lambda: worker.pid in self._worker_errors, 1)
+            error = self._worker_errors.pop(worker.pid, None)
+        if error is None:
+            return 'worker exited with code {}'.format(worker.exitcode)
+        return error
+    
+    def _is_single_check(self, names):
+        """Return True if none of the profiles is checked periodically"""
+        for name in names:
+            try:
+                if self.config[name].getboolean('period'):
+                    return False
+            except ValueError:
+                return False
+        return True
+    
+    def _rebalance(self, i, error, shards, workers, controls, failures, done, 
+                   rebalanced, verbose):
+        """Move the profiles of a failing worker to the live workers
+        
+        The profile named in the error, or else the last one moved to the 
+        worker, is kept, as it's the likely cause. The workers taking 
+        profiles are restarted.
+        """
+        live = [j for j in range(len(shards)) 
+                if j != i and j not in done and workers[j] is not None]
+        if len(shards[i]) < 2 or not live:
+            return
+        kept = next((name for name in shards[i] if re.search(
+                        r'(?<!\w){}(?!\w)'.format(re.escape(name)), error)), 
+                    shards[i][-1])
+        loads = {j: sum(self.config[name].getint('account_connections') 
+                        for name in shards[j]) for j in live}
+        for name in shards[i]:
+            if name == kept:
+                continue
+            j = min(live, key=loads.get)
+            shards[j].append(name)
+            loads[j] += self.config[name].getint('account_connections')
+            if workers[j] is not None and j not in rebalanced:
+                rebalanced.add(j)
+                try:
+                    controls[j].send(None)
+                except OSError:
+                    pass
+            if verbose:
+                print('moving {} from worker {} to worker {}'.format(name, i, 
+                                                                     j))
+        shards[i][:] = [kept]
+    
+    def _receive(self, results):
+        """Pass the notifications and metrics from the workers on"""
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            if item[0] == 'notification':
+                self.dispatcher.put(*item[1:])
+            elif item[0] == 'discard':
+                self.dispatcher.discard(*item[1:])
+            elif item[0] == 'metrics':
+                self.metrics.add(item[1])
+            elif item[0] == 'error':
+                with self._worker_error_received:
+                    self._worker_errors[item[1]] = item[2]
+                    self._worker_error_received.notify_all()
+    
+    def cancel(self, cancel_all=True, logout=True):
+        self._cancel.set()
+        EmailChecker.cancel(self, cancel_all, logout)
 
 
+@functools.lru_cache(maxsize=1024)
 def decode_imap_utf7(text):
     """Decode a byte string according to RFC 3501, section 5.1.3"""
     if isinstance(text, bytes):
         text = text.decode('ascii')
-    decoded = []
-    imap_utf7_text = []
-    for chr in text:
-        if imap_utf7_text:
-            if chr == '-':
-                if len(imap_utf7_text) == 1:
-                    decoded.append('&')
-                else:
-                    imap_utf7_text = b'+' + ''.join(
-                        imap_utf7_text[1:]).encode('ascii').replace(b',', b'/')\
-                        + b'-'
-                    decoded.append(imap_utf7_text.decode('utf-7'))
-                imap_utf7_text = []
-            else:
-                imap_utf7_text.append(chr)
-        elif chr == '&':
-            imap_utf7_text.append(chr)
+    if '&' not in text:
+        return text
+    return re_imap_utf7.sub(_decode_imap_utf7_match, text)
+
+
+def translate_glob(pattern):
+    """Return a regular expression matching a whole glob pattern
+    
+    Only '*' and '?' are wildcards, unlike fnmatch, as brackets are common 
+    in mailbox names and subjects, e.g. '[Gmail]'.
+    """
+    return '(?s:{})\\Z'.format('.*'.join('.'.join(map(re.escape, 
+                                                       part.split('?'))) 
+                                          for part in pattern.split('*')))
+
+
+re_imap_utf7 = re.compile(r'&([^-]*)(-|\Z)')
+
+
+def _decode_imap_utf7_match(match):
+    if not match.group(2): # unterminated, dropped
+        return ''
+    if not match.group(1):
+        return '&'
+    return ('+' + match.group(1).replace(',', '/') + '-').encode('ascii')\
+                                                            .decode('utf-7')
+
+
+def decode_header(raw_header):
+    """Decode a header value with RFC 2047 encoded words into a string
+    
+    A missing header field, None, is decoded as an empty string.
+    """
+    if raw_header is None:
+        return ''
+    if isinstance(raw_header, str):
+        if '=?' not in raw_header:
+            return raw_header
+        return _decode_header(raw_header)
+    # e.g. email.header.Header instances, not hashable
+    return _decode_header.__wrapped__(raw_header)
+
+
+@functools.lru_cache(maxsize=4096)
+def _decode_header(raw_header):
+    header = []
+    for header_part, header_part_charset in \
+                                    email.header.decode_header(raw_header):
+        if header_part_charset is not None:
+            header.append(header_part.decode(header_part_charset))
+        elif isinstance(header_part, bytes):
+            header.append(header_part.decode())
+        else:
+            header.append(header_part)
+    return ''.join(header)
+
+
+def uid_set(uids):
+    """Return a compact IMAP sequence set from a sorted list of UIDs"""
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
         else:
-            decoded.append(chr)
-    return ''.join(decoded)
+            ranges.append([uid, uid])
+    return ','.join(str(first) if first == last else 
+                    '{}:{}'.format(first, last) for first, last in ranges)
+
+
+def format_time(timestamp):
+    """Return a time.time() timestamp as a local ISO 8601 string"""
+    return datetime.fromtimestamp(timestamp, timezone.utc).astimezone()\
+                                                            .isoformat()
+
+
+def send_control_command(path, command, timeout=10):
+    """Send a command to a running checker through its control socket
+    
+    Return the reply, decoded from JSON.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(command.encode() + b'\n')
+        with sock.makefile('rb') as reply:
+            return json.loads(reply.readline().decode())
+
+
+def run_worker(config_string, profiles, results, control, collect_metrics):
+    """Check some profiles, in a worker process of a Supervisor
+    
+    The worker exits when something is received from the 'control' pipe, 
+    or when it's closed because the supervisor is gone. Its error, if it 
+    fails, is passed on to the supervisor before exiting.
+    """
+    try:
+        _run_worker(config_string, profiles, results, control, 
+                    collect_metrics)
+    except SystemExit as err:
+        if err.code not in (None, 0):
+            results.put(('error', os.getpid(), str(err.code)))
+        raise
+    except Exception as err:
+        results.put(('error', os.getpid(), 
+                     '{}: {}'.format(type(err).__name__, err)))
+        raise
+
+
+def _run_worker(config_string, profiles, results, control, collect_metrics):
+    email_checker = EmailChecker()
+    email_checker.read_config(config_string=config_string)
+    email_checker = MultiChecker(config=email_checker.config, 
+                                 profiles=profiles)
+    email_checker.dispatcher = WorkerDispatcher(results)
+    if collect_metrics:
+        email_checker.metrics = Metrics()
+    for checkers in email_checker.accounts.values():
+        for checker in checkers:
+            checker.dispatcher = email_checker.dispatcher
+            checker.metrics = email_checker.metrics
+    
+    def watch_supervisor():
+        while not control.poll(Supervisor.report_interval):
+            if collect_metrics:
+                results.put(('metrics', email_checker.metrics.take()))
+        email_checker._queue.put(email_checker.exit)
+    
+    threading.Thread(target=watch_supervisor, daemon=True).start()
+    email_checker.check()
+    try:
+        email_checker.wait()
+    finally:
+        if collect_metrics:
+            results.put(('metrics', email_checker.metrics.take()))
+
+
+def get_memory_usage(pid):
+    """Return the resident memory of a process in bytes, None if unknown
+    
+    Only supported on Linux.
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid)) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
 
 
 if __name__ == '__main__':
     
+    multiprocessing.freeze_support()
     email_checker = EmailChecker()
     email_checker.parse_command_line()
+    general = email_checker.config['general']
+    if email_checker.control_command is not None:
+        if not general.get('control_socket'):
+            raise SystemExit('no control_socket in the settings')
+        try:
+            reply = send_control_command(general['control_socket'], 
+                                         email_checker.control_command)
+        except OSError as err:
+            raise SystemExit('{}: {}'.format(general['control_socket'], err))
+        print(json.dumps(reply, indent=1))
+        raise SystemExit(0 if reply['ok'] else 1)
+    if general.getint('workers', 0):
+        email_checker = Supervisor(config=email_checker.config)
+    elif general.getboolean('all_profiles'):
+        email_checker = MultiChecker(config=email_checker.config)
     email_checker.register_gntp()
+    email_checker.start_metrics()
+    email_checker.start_control()
     email_checker.check()
     try:
         email_checker.wait()
     except (KeyboardInterrupt, SystemExit) as err:
         email_checker.cancel()
+        email_checker._close_control()
         raise SystemExit(err)